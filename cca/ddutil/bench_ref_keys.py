@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+
+if __name__ == '__main__':
+    from cca.dd.bench_ref_keys import main
+    main()
@@ -1,12 +1,10 @@
 #!/usr/bin/env python3
 
 import os
-# import sys
+import sys
 
-from cca.dd import misc
 from cca.dd.conf import FB_DIR, VIRTUOSO_PW, VIRTUOSO_PORT
-
-from cca.ccautil import virtuoso
+from cca.dd.supervisor import Supervisor
 
 if __name__ == '__main__':
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
@@ -28,7 +26,6 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    if misc.is_virtuoso_running(args.port):
-        fb_dir = os.path.join(FB_DIR, args.proj_id)
-        v = virtuoso.base(dbdir=fb_dir, pw=args.pw, port=args.port)
-        v.shutdown_server()
+    fb_dir = os.path.join(FB_DIR, args.proj_id)
+    sv = Supervisor(fb_dir, port=args.port, pw=args.pw)
+    sys.exit(sv.shutdown())
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+'''
+  batch.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import sys
+import json
+import time
+import queue
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import psutil
+
+from .common import LOG_DIR, VIRTUOSO_PW, VIRTUOSO_PORT, get_proj_id
+from .misc import ensure_dir, get_timestamp
+from .virtuoso_ini import parse_mem, AUTO
+
+from cca.ccautil.common import setup_logger, DEFAULT_LOGGING_LEVEL
+
+logger = logging.getLogger()
+
+GB = 1024 ** 3
+AUTO_SLOT_GB = 8  # memory per project for sizing slots with --mem auto
+
+REPORT_INTERVAL = 60
+
+
+def read_manifest(path):
+    # JSON: [{"proj_dir": DIR, "commit_ids": [CID,...], "proj_id": ID,
+    #         "include": [DIR,...], "options": [OPT,...]}, ...]
+    # otherwise: one "PROJ_DIR CID..." per line
+    projs = []
+    if path.endswith('.json'):
+        with open(path) as f:
+            for d in json.load(f):
+                projs.append(d)
+    else:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                xs = line.split()
+                projs.append({'proj_dir': xs[0], 'commit_ids': xs[1:]})
+    seen = set()
+    for d in projs:
+        if d.get('proj_id', None) is None:
+            d['proj_id'] = get_proj_id(d['proj_dir'])
+        # projects running concurrently must not share FB, fact and log directories
+        if d['proj_id'] in seen:
+            raise ValueError(f'duplicate proj_id: {d["proj_id"]} (give "proj_id" explicitly)')
+        seen.add(d['proj_id'])
+    return projs
+
+
+def get_nslots(mem, nprocs=None):
+    avail = psutil.virtual_memory().available
+    slot_mem = AUTO_SLOT_GB if mem == AUTO else mem
+    n = max(1, int(avail // (slot_mem * GB)))
+    logger.info(f'available memory: {avail / GB:.1f}GB, {n} slots for {slot_mem}GB each')
+    if nprocs is not None:
+        n = min(n, nprocs)
+    return n
+
+
+def get_status_file(proj_id):
+    return os.path.join(LOG_DIR, 'rrj', proj_id, 'status')
+
+
+def read_status(proj_id):
+    s = None
+    try:
+        with open(get_status_file(proj_id)) as f:
+            s = f.read().strip()
+    except Exception:
+        pass
+    return s
+
+
+class Runner(object):
+    def __init__(self, ports, mem=8, pw=VIRTUOSO_PW, extra_opts=[]):
+        self.nslots = len(ports)
+        self.mem = mem
+        self.pw = pw
+        self.extra_opts = extra_opts
+        self._ports = queue.Queue()
+        for p in ports:
+            self._ports.put(p)
+
+    def make_cmd(self, proj, port):
+        cmd = [sys.executable, '-m', 'cca.dd.rrj',
+               '--proj-id', proj['proj_id'],
+               '--port', str(port),
+               '--pw', self.pw,
+               '--mem', str(self.mem),
+               '--fbs', str(self.nslots),
+               '--status-file', get_status_file(proj['proj_id'])]
+        for d in proj.get('include', []):
+            cmd += ['--include', d]
+        cmd += self.extra_opts
+        cmd += [str(x) for x in proj.get('options', [])]
+        cmd += [proj['proj_dir']] + proj['commit_ids']
+        return cmd
+
+    def run(self, proj):
+        proj_id = proj['proj_id']
+        port = self._ports.get()
+        result = {'proj_id': proj_id, 'port': port, 'started': get_timestamp()}
+        t0 = time.monotonic()
+        try:
+            ensure_dir(os.path.dirname(get_status_file(proj_id)))
+            cmd = self.make_cmd(proj, port)
+            logger.info(f'[{proj_id}] {" ".join(cmd)}')
+            p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            result['rc'] = p.returncode
+            if p.returncode != 0:
+                err = p.stderr.decode('utf-8', errors='replace').strip()
+                result['error'] = err.splitlines()[-1] if err else ''
+        except Exception as e:
+            result['rc'] = 1
+            result['error'] = str(e)
+        finally:
+            self._ports.put(port)
+        result['finished'] = get_timestamp()
+        result['elapsed'] = time.monotonic() - t0
+        result['status'] = read_status(proj_id)
+        return result
+
+
+def run_batch(projs, nslots, ports, mem=8, pw=VIRTUOSO_PW, extra_opts=[], out_file=None):
+    runner = Runner(ports, mem=mem, pw=pw, extra_opts=extra_opts)
+    results = []
+    nprojs = len(projs)
+    with ThreadPoolExecutor(max_workers=nslots) as executor:
+        running = {executor.submit(runner.run, proj): proj['proj_id'] for proj in projs}
+        while running:
+            done, _ = wait(running.keys(), timeout=REPORT_INTERVAL,
+                           return_when=FIRST_COMPLETED)
+            for fut in done:
+                proj_id = running.pop(fut)
+                result = fut.result()
+                results.append(result)
+                stat = 'done' if result['rc'] == 0 else f'failed (rc={result["rc"]})'
+                print(f'[{len(results)}/{nprojs}] {proj_id}: {stat}'
+                      f' in {result["elapsed"]:.0f}s')
+                logger.info(f'{proj_id}: {result}')
+                if out_file is not None:
+                    with open(out_file, 'w') as f:
+                        json.dump(results, f, indent=1)
+            if not done:
+                for proj_id in running.values():
+                    s = read_status(proj_id)
+                    if s:
+                        print(f'  {proj_id}: {s}')
+    nfailed = len([r for r in results if r['rc'] != 0])
+    print(f'finished: {nprojs - nfailed} succeeded, {nfailed} failed')
+    return results
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, REMAINDER
+
+    parser = ArgumentParser(description='Run rrj on multiple projects',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('manifest', type=str,
+                        help='JSON list of projects or text file of "PROJ_DIR CID..." lines')
+
+    parser.add_argument('-p', '--nprocs', dest='nprocs', type=int, default=None,
+                        help='max number of concurrent projects (sized from memory by default)')
+
+    parser.add_argument('--port', dest='port', default=VIRTUOSO_PORT,
+                        metavar='PORT', type=int, help='set first port number of the pool')
+
+    parser.add_argument('--pw', dest='pw', metavar='PASSWORD',
+                        default=VIRTUOSO_PW,
+                        help='set password to access FB')
+
+    parser.add_argument('-m', '--mem', dest='mem', metavar='GB', type=parse_mem, default=8,
+                        help='set available memory (GB) per project, or "auto" to share'
+                        f' memory and CPUs among concurrent projects ({AUTO_SLOT_GB}GB'
+                        ' assumed per project for sizing the pool)')
+
+    parser.add_argument('-o', '--out', dest='out_file', metavar='JSON_FILE',
+                        default='rrj-batch.json', help='dump per-project results into JSON_FILE')
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='enable verbose printing')
+
+    parser.add_argument('rrj_opts', nargs=REMAINDER,
+                        help='options passed to every rrj run (after "--")')
+
+    args = parser.parse_args()
+
+    log_level = DEFAULT_LOGGING_LEVEL  # logging.WARNING
+    if args.verbose:
+        log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+
+    log_dir = os.path.join(LOG_DIR, 'rrj')
+    ensure_dir(log_dir)
+    setup_logger(logger, log_level, log_file=os.path.join(log_dir, 'batch.log'))
+
+    try:
+        projs = read_manifest(args.manifest)
+    except ValueError as e:
+        parser.error(str(e))
+
+    nslots = min(get_nslots(args.mem, args.nprocs), max(1, len(projs)))
+    ports = [args.port + i for i in range(nslots)]
+
+    extra_opts = [x for x in args.rrj_opts if x != '--']
+
+    print(f'running {len(projs)} projects in {nslots} slots (ports: {ports})...')
+
+    run_batch(projs, nslots, ports, mem=args.mem, pw=args.pw,
+              extra_opts=extra_opts, out_file=args.out_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+'''
+  bench_ref_keys.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import json
+import time
+import random
+
+from .ref import Ref, Desc
+from .ref_keys import add_ref, add_dtor
+
+# deduplication of ref_keys.dump and dump_dtor_map over a synthetic row stream
+
+
+def gen_ref_rows(ncids, nrows, dup_ratio, seed=0):
+    # yields (cid, Ref) with about dup_ratio of them repeated
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(nrows):
+        if rows and rnd.random() < dup_ratio:
+            cid, r = rnd.choice(rows)
+        else:
+            cid = f'{rnd.randrange(ncids):040x}'
+            v = f'v{i}'
+            key = f'RV {v}:I->{v}_:I m()V C{i % 97}'
+            loc = f'src/C{i % 97}.java'
+            r = Ref(key, Desc(i, 3, f'{v}_', loc), Desc(i + 5, 4, v, loc))
+            rows.append((cid, r))
+        yield cid, r
+
+
+def gen_dtor_rows(ncids, nrows, dup_ratio, seed=0):
+    # yields (version name, key, dtor dict) with about dup_ratio of them repeated
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(nrows):
+        if rows and rnd.random() < dup_ratio:
+            ver, key, d = rnd.choice(rows)
+        else:
+            ver = f'{rnd.randrange(ncids):040x}-before'
+            key = f'v{int(rnd.paretovariate(1.2)) % 1000}:I'  # a few names are common
+            d = {
+                'meth': f'm{i % 50}()V',
+                'class': f'C{i % 97}',
+                'loc': f'src/C{i % 97}.java',
+                'offset': str(i),
+                'length': '3',
+            }
+            rows.append((ver, key, d))
+        yield ver, key, dict(d)
+
+
+def dedup_refs_linear(rows):
+    tbl = {}
+    for cid, r in rows:
+        rl = tbl.setdefault(cid, {}).setdefault('RV', [])
+        rd = r.to_dict()
+        if rd not in rl:
+            rl.append(rd)
+    return tbl
+
+
+def dedup_refs_hashed(rows):
+    tbl = {}
+    seen = set()
+    for cid, r in rows:
+        add_ref(tbl, seen, 'RV', cid, r)
+    return tbl
+
+
+def dedup_dtors_linear(rows):
+    tbl = {}
+    for ver, key, d in rows:
+        rl = tbl.setdefault(ver, {}).setdefault(key, [])
+        if d not in rl:
+            rl.append(d)
+    return tbl
+
+
+def dedup_dtors_hashed(rows):
+    tbl = {}
+    seen = set()
+    for ver, key, d in rows:
+        add_dtor(tbl, seen, [ver], key, d, None)
+    return tbl
+
+
+def bench(name, f, rows):
+    t0 = time.perf_counter()
+    tbl = f(rows)
+    t = time.perf_counter() - t0
+    print(f'{name:20s} {t:8.3f}s')
+    return json.dumps(tbl)
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(description='Benchmark deduplication of ref keys and dtor maps',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-n', '--rows', dest='nrows', metavar='N', type=int, default=50000,
+                        help='number of rows')
+
+    parser.add_argument('-c', '--cids', dest='ncids', metavar='N', type=int, default=2,
+                        help='number of commits')
+
+    parser.add_argument('-d', '--dup-ratio', dest='dup_ratio', metavar='R', type=float,
+                        default=0.3, help='ratio of duplicated rows')
+
+    args = parser.parse_args()
+
+    print(f'{args.nrows} rows, {args.ncids} commits, dup_ratio={args.dup_ratio}')
+
+    rows = list(gen_ref_rows(args.ncids, args.nrows, args.dup_ratio))
+    x = bench('ref_keys (linear)', dedup_refs_linear, rows)
+    y = bench('ref_keys (hashed)', dedup_refs_hashed, rows)
+    print(f'identical: {x == y}')
+
+    rows = list(gen_dtor_rows(args.ncids, args.nrows, args.dup_ratio))
+    x = bench('dtor_map (linear)', dedup_dtors_linear, rows)
+    y = bench('dtor_map (hashed)', dedup_dtors_hashed, rows)
+    print(f'identical: {x == y}')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,7 @@
 
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
+import os
 import re
 
 from .conf import VAR_DIR, FACT_DIR, LOG_DIR, FB_DIR
@@ -120,6 +121,31 @@ def abbrev(ref):
     return s
 
 
+ABBREV_TBL = {abbrev(x): x for x in REFACTORING_LIST}
+
+
+def parse_targets(s):
+    # for argparse: abbreviated refactoring types separated by ":" (e.g. "RV:RP")
+    targets = []
+    for x in s.split(':'):
+        try:
+            ref = ABBREV_TBL[x]
+        except KeyError:
+            choices = ', '.join(ABBREV_TBL.keys())
+            raise ValueError(f'invalid refactoring type: {x} (choose from {choices})')
+        if ref not in targets:
+            targets.append(ref)
+    return targets
+
+
+def get_proj_id(proj_dir):
+    # project id derived from a project directory or git repository
+    proj_id = os.path.basename(os.path.normpath(proj_dir))
+    if proj_id.endswith('.git'):
+        proj_id = proj_id[:-len('.git')]
+    return proj_id
+
+
 if __name__ == '__main__':
     print(f'VAR_DIR: {VAR_DIR}')
     print(f'fACT_DIR: {FACT_DIR}')
@@ -20,3 +20,6 @@ WORK_DIR = os.path.join(VAR_DIR, 'work')
 REFACT_DIR = os.path.join(VAR_DIR, 'refactoring')
 
 PARSER_CMD = '/opt/cca/bin/parsesrc.opt'
+
+VIRTUOSO_DIR = os.getenv('VIRTUOSO_DIR', '/opt/virtuoso')
+ISQL_CMD = os.path.join(VIRTUOSO_DIR, 'bin', 'isql')
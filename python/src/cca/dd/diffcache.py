@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+'''
+  diffcache.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import time
+import fcntl
+import shlex
+import shutil
+import logging
+import subprocess
+import contextlib
+
+from .misc import ensure_dir, read_json
+from .manifest import fingerprint
+
+logger = logging.getLogger()
+
+GB = 1024 ** 3
+
+INDEX_FILE_NAME = 'index.json'
+LOCK_FILE_NAME = 'index.lock'
+READERS_LOCK_FILE_NAME = 'readers.lock'
+
+USED_STAMP_NAME = '.used'  # touched in an entry each time a run uses it
+
+LOW_WATER = 0.9  # evict down to this ratio of max size
+MIN_AGE = 3600   # entries used within MIN_AGE seconds are never evicted
+FULL_SCAN_INTERVAL = 86400  # for entries written by diffast runs not recording use
+MTIME_SLACK = 60  # for coarse mtime granularity and clock skew
+
+
+def get_entry_dir(diff_cmd, cache_dir, path1, path2):
+    # directory of the entry of the file pair as named by diffast, or None
+    cmd = shlex.split(diff_cmd) + ['-cache', cache_dir, '-getcache', path1, path2]
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                           check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug(f'failed to get cache entry of "{path1}" and "{path2}": {e}')
+        return None
+    d = p.stdout.decode('utf-8').strip()
+    return d if d else None
+
+
+def record_use(diff_cmd, cache_dir, file_pairs):
+    # touches the stamps of the entries of the file pairs
+    # returns the number of entries stamped
+    count = 0
+    for path1, path2 in file_pairs:
+        d = get_entry_dir(diff_cmd, cache_dir, path1, path2)
+        if d is None or not os.path.isdir(d):
+            continue
+        try:
+            with open(os.path.join(d, USED_STAMP_NAME), 'a'):
+                pass
+            os.utime(os.path.join(d, USED_STAMP_NAME))
+            count += 1
+        except OSError as e:
+            logger.debug(f'{d}: {e}')
+    return count
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+
+def get_opts_key(opts):
+    return fingerprint(opts)[:16]
+
+
+class DiffCache(object):
+    # diffast names its cache entries by the content digests of the compared files,
+    # so an entry is shared by every project (and fork) having the same file pair.
+    # entries are put into a sub-directory per set of diff options and evicted
+    # in LRU order once their total size exceeds max_bytes.
+    # diffast only reads an entry on a hit, so runs record use explicitly by
+    # touching a stamp in each entry they compared a file pair with (record_use).
+    # the index is refreshed incrementally: only directories modified or stamped
+    # since the last scan are listed (so files rewritten in place by a run are seen),
+    # and every entry is stat'ed by a full scan once a day.
+    def __init__(self, base_dir, max_gb=32):
+        self.base_dir = base_dir
+        self.max_bytes = int(max_gb * GB)
+        self.index_path = os.path.join(base_dir, INDEX_FILE_NAME)
+        self.lock_path = os.path.join(base_dir, LOCK_FILE_NAME)
+        self.readers_lock_path = os.path.join(base_dir, READERS_LOCK_FILE_NAME)
+        ensure_dir(base_dir)
+
+    @contextlib.contextmanager
+    def reading(self):
+        # entries are not evicted while any process is inside this block
+        with open(self.readers_lock_path, 'a') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_SH)
+            try:
+                yield self
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def get_dir(self, opts):
+        d = os.path.join(self.base_dir, get_opts_key(opts))
+        if not os.path.exists(d):
+            ensure_dir(d)
+            with open(os.path.join(d, 'opts.json'), 'w') as f:
+                json.dump(opts, f, sort_keys=True, default=str)
+        return d
+
+    def read_index(self):
+        # {'scanned': time, 'full_scanned': time, 'entries': entry -> info}
+        tbl = None
+        if os.path.exists(self.index_path):
+            tbl = read_json(self.index_path)
+        if tbl is None or 'entries' not in tbl:
+            tbl = {'scanned': 0, 'full_scanned': 0, 'entries': {}}
+        return tbl
+
+    def write_index(self, tbl):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(tbl, f)
+        os.replace(tmp, self.index_path)
+
+    def scan(self, old_tbl, since=0):
+        # entry (relative path) -> {'size': bytes, 'used': time}
+        # entries indexed in old_tbl whose directories are neither modified nor
+        # stamped since since are taken from old_tbl as they are
+        tbl = {}
+
+        def scan_dir(path, top=False):
+            ent = os.path.relpath(path, self.base_dir)
+            size = 0
+            used = 0
+            nfiles = 0
+            try:
+                it = list(os.scandir(path))
+            except OSError:
+                return
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        sub = os.path.relpath(e.path, self.base_dir)
+                        if sub in old_tbl and e.stat().st_mtime < since \
+                           and get_mtime(os.path.join(e.path, USED_STAMP_NAME)) < since:
+                            tbl[sub] = old_tbl[sub]
+                        else:
+                            scan_dir(e.path)
+                    elif not top:
+                        st = e.stat()
+                        size += st.st_size
+                        used = max(used, st.st_atime, st.st_mtime)
+                        nfiles += 1
+                except OSError:
+                    continue
+            if nfiles:
+                try:
+                    used = max(used, old_tbl[ent]['used'])
+                except KeyError:
+                    pass
+                tbl[ent] = {'size': size, 'used': used}
+
+        for key in os.listdir(self.base_dir):
+            kdir = os.path.join(self.base_dir, key)
+            if os.path.isdir(kdir):
+                scan_dir(kdir, top=True)
+        return tbl
+
+    def remove_entry(self, ent):
+        p = os.path.join(self.base_dir, ent)
+        shutil.rmtree(p, ignore_errors=True)
+        d = os.path.dirname(p)
+        while os.path.dirname(d) != os.path.normpath(self.base_dir):
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            d = os.path.dirname(d)
+
+    def update(self, full=False):
+        # refreshes the index and evicts least recently used entries
+        # unless some process is reading the cache
+        # returns (nentries, total size, nevicted)
+        with open(self.lock_path, 'w') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                index = self.read_index()
+                now = time.time()
+                full = full or now - index['full_scanned'] > FULL_SCAN_INTERVAL
+                since = 0 if full else index['scanned'] - MTIME_SLACK
+                tbl = self.scan(index['entries'], since=since)
+                total = sum(d['size'] for d in tbl.values())
+                nevicted = 0
+                if total > self.max_bytes:
+                    nevicted = self.evict(tbl, total, now)
+                    total = sum(d['size'] for d in tbl.values())
+                index = {
+                    'scanned': now,
+                    'full_scanned': now if full else index['full_scanned'],
+                    'entries': tbl,
+                }
+                self.write_index(index)
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+        return len(tbl), total, nevicted
+
+    def evict(self, tbl, total, now):
+        with open(self.readers_lock_path, 'a') as lockf:
+            try:
+                fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f'"{self.base_dir}" is being read, eviction postponed')
+                return 0
+            try:
+                limit = self.max_bytes * LOW_WATER
+                nevicted = 0
+                for ent, d in sorted(tbl.items(), key=lambda x: x[1]['used']):
+                    if total <= limit or now - d['used'] < MIN_AGE:
+                        break
+                    self.remove_entry(ent)
+                    total -= d['size']
+                    del tbl[ent]
+                    nevicted += 1
+                logger.info(f'evicted {nevicted} entries from "{self.base_dir}"')
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+        return nevicted
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+'''
+  dtor_index.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger()
+
+# SQLite index of dtor_map.json keyed by (version name, vname:vty)
+
+DTOR_INDEX_EXT = '.db'
+
+SCHEMA = '''
+CREATE TABLE meta (src_size INTEGER, src_mtime INTEGER);
+CREATE TABLE dtor (
+  ver TEXT NOT NULL, vt TEXT NOT NULL, meth TEXT, class TEXT,
+  loc TEXT, offset TEXT, length TEXT
+);
+'''
+INDEX = 'CREATE INDEX dtor_key ON dtor (ver, vt, meth, class);'
+
+FIELDS = ['meth', 'class', 'loc', 'offset', 'length']
+
+_conn_tbl = {}  # (pid, index path) -> connection
+_lock = threading.Lock()
+
+
+def get_index_path(dtor_json):
+    return os.path.splitext(dtor_json)[0] + DTOR_INDEX_EXT
+
+
+def get_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def is_stale(dtor_json, index_path=None):
+    if index_path is None:
+        index_path = get_index_path(dtor_json)
+    if not os.path.exists(index_path):
+        return True
+    try:
+        conn = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+        try:
+            row = conn.execute('SELECT src_size, src_mtime FROM meta').fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f'{index_path}: {e}')
+        return True
+    return row is None or tuple(row) != get_stamp(dtor_json)
+
+
+def build(dtor_json, index_path=None):
+    # returns the number of entries indexed
+    if index_path is None:
+        index_path = get_index_path(dtor_json)
+    stamp = get_stamp(dtor_json)
+
+    logger.info(f'loading "{dtor_json}"...')
+    with open(dtor_json) as f:
+        tbl = json.load(f)
+
+    def rows():
+        for ver, ktbl in tbl.items():
+            for vt, dl in ktbl.items():
+                for d in dl:
+                    yield (ver, vt, *(d.get(x, None) for x in FIELDS))
+
+    logger.info(f'indexing into "{index_path}"...')
+    tmp = f'{index_path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(SCHEMA)
+        conn.execute('INSERT INTO meta VALUES (?, ?)', stamp)
+        cur = conn.executemany('INSERT INTO dtor VALUES (?, ?, ?, ?, ?, ?, ?)', rows())
+        n = cur.rowcount
+        conn.execute(INDEX)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, index_path)
+    logger.info(f'{n} entries indexed')
+    return n
+
+
+def ensure(dtor_json):
+    # returns the path of an up-to-date index, or None if dtor_json does not exist
+    if not os.path.exists(dtor_json):
+        return None
+    index_path = get_index_path(dtor_json)
+    with _lock:
+        if is_stale(dtor_json, index_path):
+            _close(index_path)
+            build(dtor_json, index_path)
+    return index_path
+
+
+def _close(index_path):
+    conn = _conn_tbl.pop((os.getpid(), index_path), None)
+    if conn is not None:
+        conn.close()
+
+
+def get_conn(index_path):
+    key = (os.getpid(), index_path)
+    try:
+        return _conn_tbl[key]
+    except KeyError:
+        conn = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        _conn_tbl[key] = conn
+        return conn
+
+
+def lookup(index_path, ver, vt, meth=None, cls=None):
+    # dtor entries of ver for vt (restricted to meth and cls if given), in dump order
+    query = 'SELECT meth, class, loc, offset, length FROM dtor WHERE ver = ? AND vt = ?'
+    params = [ver, vt]
+    if meth is not None:
+        query += ' AND meth = ?'
+        params.append(meth)
+    if cls is not None:
+        query += ' AND class = ?'
+        params.append(cls)
+    query += ' ORDER BY rowid'
+    with _lock:
+        rows = get_conn(index_path).execute(query, params).fetchall()
+    return [dict(row) for row in rows]
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(description='Build an index of dtor_map.json',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('dtor_json', metavar='JSON_FILE', type=str,
+                        help='dtor map (dumped by ref_keys)')
+
+    parser.add_argument('-o', '--out', dest='out', metavar='DB_FILE', default=None,
+                        help=f'write the index into DB_FILE (default: JSON_FILE with'
+                        f' "{DTOR_INDEX_EXT}" extension)')
+
+    args = parser.parse_args()
+
+    n = build(args.dtor_json, args.out)
+    print(f'{n} entries indexed')
+
+
+if __name__ == '__main__':
+    main()
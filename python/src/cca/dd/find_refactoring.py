@@ -21,19 +21,31 @@
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import os.path
-# import logging
+import re
+import json
+import shutil
+import tempfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from .conf import CCA_HOME
+from .common import RENAME_METHOD, RENAME_PARAMETER, RENAME_VARIABLE, RENAME_ATTRIBUTE
+from .common import CHANGE_RETURN_TYPE
+from .common import CHANGE_PARAMETER_TYPE, CHANGE_VARIABLE_TYPE, CHANGE_ATTRIBUTE_TYPE
+from .common import EXTRACT_VARIABLE, INLINE_VARIABLE
 from cca.ccautil import find_change_patterns
 from cca.ccautil.find_change_patterns import Predicates
 from cca.ccautil.ns import REF_NS, JREF_NS, CREF_NS
 
 from cca.factutil.rdf import Predicate
 
-# logger = logging.getLogger()
+logger = logging.getLogger()
 
 QUERY_DIR = os.path.join(CCA_HOME, 'queries', 'refactoring')
 
+# Turtle files tagged by merge_tree
+TAGGED_TTL_PAT = re.compile(r'\.[a-z]+-[0-9]{2,}\.ttl$')
+
 
 class FactExtractor(find_change_patterns.FactExtractor):
 
@@ -160,13 +172,195 @@ def get_queries(weak=False):
 
 QUERIES = get_queries(weak=False)
 
+# detection query -> refactoring type
+QUERY_REF_TBL = {
+    'local_variable_rename.rq': RENAME_VARIABLE,
+    'rename_parameter.rq': RENAME_PARAMETER,
+    'rename_field.rq': RENAME_ATTRIBUTE,
+    'rename_method.rq': RENAME_METHOD,
+    'weak_rename_method.rq': RENAME_METHOD,
+    'change_parameter_type.rq': CHANGE_PARAMETER_TYPE,
+    'change_variable_type.rq': CHANGE_VARIABLE_TYPE,
+    'change_field_type.rq': CHANGE_ATTRIBUTE_TYPE,
+    'change_return_type.rq': CHANGE_RETURN_TYPE,
+    'extract_variable.rq': EXTRACT_VARIABLE,
+    'inline_variable.rq': INLINE_VARIABLE,
+}
+
+
+def get_target_queries(targets=None):
+    # QUERIES restricted to the detection queries for targets (refactoring types)
+    if targets is None:
+        return QUERIES
+    queries = {}
+    for lang, ql in QUERIES.items():
+        queries[lang] = [q for q in ql if QUERY_REF_TBL.get(q[0], None) in targets]
+    return queries
+
+
+def read_query(name, lang='java'):
+    text = None
+    path = os.path.join(QUERY_DIR, lang, name)
+    if os.path.exists(path):
+        with open(path) as f:
+            text = f.read()
+    return text
+
+
+def merge_json(x, y):
+    # values that differ otherwise are kept both in a list
+    if isinstance(x, list) and isinstance(y, list):
+        return x + y
+    if isinstance(x, dict) and isinstance(y, dict):
+        z = dict(x)
+        for k, v in y.items():
+            z[k] = merge_json(z[k], v) if k in z else v
+        return z
+    if x == y:
+        return x
+    xs = x if isinstance(x, list) else [x]
+    ys = y if isinstance(y, list) else [y]
+    return xs + ys
+
+
+def merge_tree(src_dir, dst_dir, tag):
+    # moves files into dst_dir, merging into those already there
+    # (JSON files structurally, Turtle files kept apart as their blank nodes
+    # are scoped to the document, others by concatenation)
+    if not os.path.isdir(src_dir):
+        return
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        d = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(d, exist_ok=True)
+        for fn in sorted(files):
+            src = os.path.join(root, fn)
+            dst = os.path.join(d, fn)
+            if not os.path.exists(dst):
+                shutil.move(src, dst)
+            elif fn.endswith('.json'):
+                with open(dst) as f:
+                    x = json.load(f)
+                with open(src) as f:
+                    y = json.load(f)
+                with open(dst, 'w') as f:
+                    json.dump(merge_json(x, y), f)
+            elif fn.endswith('.ttl'):
+                stem, ext = os.path.splitext(fn)
+                shutil.move(src, os.path.join(d, f'{stem}.{tag}{ext}'))
+            else:
+                with open(dst, 'ab') as f, open(src, 'rb') as g:
+                    shutil.copyfileobj(g, f)
+
+
+def remove_tagged(dir_path):
+    # removes Turtle files tagged by an earlier run
+    if not os.path.isdir(dir_path):
+        return
+    for root, dirs, files in os.walk(dir_path):
+        for fn in files:
+            if TAGGED_TTL_PAT.search(fn):
+                os.remove(os.path.join(root, fn))
+
+
+def install_tree(src_dir, dst_dir):
+    # moves files into dst_dir replacing those there
+    # (tagged Turtle files of earlier runs are removed)
+    remove_tagged(dst_dir)
+    for root, dirs, files in os.walk(src_dir):
+        d = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(d, exist_ok=True)
+        for fn in files:
+            os.replace(os.path.join(root, fn), os.path.join(d, fn))
+
+
+def swap_tree(src_dir, dst_dir):
+    # replaces dst_dir as a whole with src_dir (on the same file system)
+    old_dir = None
+    if os.path.exists(dst_dir):
+        shutil.copymode(dst_dir, src_dir)
+        old_dir = make_stage_dir(dst_dir)
+        os.rename(dst_dir, os.path.join(old_dir, 'old'))
+    else:
+        os.chmod(src_dir, 0o755)
+    os.rename(src_dir, dst_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def make_stage_dir(dst_dir):
+    # a fresh directory on the file system of dst_dir
+    parent = os.path.dirname(os.path.abspath(dst_dir))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f'.{os.path.basename(dst_dir)}-', dir=parent)
+
+
+def find_mt(queries, base_dir, proj_id, foutdir, outdir, pw, port,
+            limit, lang, method, change_enumeration, per_ver,
+            query_prec, conf, url_base_path, njobs):
+    # each query runs over its own connection into its own directories,
+    # whose files are then merged in query order into fresh directories
+    # that replace foutdir as a whole and the files of the previous run in outdir
+    # (shared with other results)
+    jobs = [(lg, i, q) for lg, ql in queries.items() for i, q in enumerate(ql)]
+    tmp_dir = tempfile.mkdtemp(prefix='find_refactoring-')
+    stage_dirs = []
+
+    def get_tag(job):
+        lg, i, q = job
+        return f'{lg}-{i:02d}'
+
+    def get_dirs(job):
+        d = os.path.join(tmp_dir, get_tag(job))
+        return os.path.join(d, 'fout'), os.path.join(d, 'out')
+
+    def run(job):
+        lg, _, q = job
+        logger.info(f'finding {q}...')
+        fd, od = get_dirs(job)
+        find_change_patterns.find(QUERY_DIR, {lg: [q]}, PREDICATE_TBL, FactExtractor,
+                                  base_dir, proj_id, fd, od, pw, port,
+                                  limit, lang, method, change_enumeration, per_ver,
+                                  query_prec, conf=conf,
+                                  url_base_path=url_base_path)
+
+    try:
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            list(executor.map(run, jobs))
+        fstage = make_stage_dir(foutdir)
+        stage_dirs.append(fstage)
+        ostage = make_stage_dir(outdir)
+        stage_dirs.append(ostage)
+        for job in jobs:
+            fd, od = get_dirs(job)
+            merge_tree(fd, fstage, get_tag(job))
+            merge_tree(od, ostage, get_tag(job))
+        swap_tree(fstage, foutdir)
+        install_tree(ostage, outdir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        for d in stage_dirs:
+            shutil.rmtree(d, ignore_errors=True)
+
 
 def find(base_dir, proj_id, foutdir, outdir, pw, port,
          limit=None, lang=None, method='odbc', change_enumeration=False,
          per_ver=False,
-         query_prec=False, conf=None, url_base_path='..'):
+         query_prec=False, conf=None, url_base_path='..', targets=None, njobs=1):
+    # njobs: number of detection queries run concurrently
+
+    queries = get_target_queries(targets)
+
+    if njobs > 1 and sum(len(ql) for ql in queries.values()) > 1:
+        find_mt(queries, base_dir, proj_id, foutdir, outdir, pw, port,
+                limit, lang, method, change_enumeration, per_ver,
+                query_prec, conf, url_base_path, njobs)
+        return
+
+    remove_tagged(foutdir)
+    remove_tagged(outdir)
 
-    find_change_patterns.find(QUERY_DIR, QUERIES, PREDICATE_TBL, FactExtractor,
+    find_change_patterns.find(QUERY_DIR, queries, PREDICATE_TBL, FactExtractor,
                               base_dir, proj_id, foutdir, outdir, pw, port,
                               limit, lang, method, change_enumeration, per_ver,
                               query_prec, conf=conf,
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+'''
+  gitsrc.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import subprocess
+import logging
+
+from .misc import ensure_dir, rmdir
+
+logger = logging.getLogger()
+
+SRC_EXTS = ['.java']
+
+
+def git(repo, *args, input=None):
+    cmd = ['git', '-C', repo] + list(args)
+    logger.debug(' '.join(cmd))
+    p = subprocess.run(cmd, input=input, capture_output=True, check=True)
+    return p.stdout
+
+
+def is_git_repo(path):
+    try:
+        git(path, 'rev-parse', '--git-dir')
+        return True
+    except Exception:
+        return False
+
+
+def get_parent(repo, cid):
+    return git(repo, 'rev-parse', f'{cid}^').decode('utf-8').strip()
+
+
+def is_target(path, include, exts=SRC_EXTS):
+    if not any(path.endswith(x) for x in exts):
+        return False
+    if include:
+        return any(path == d or path.startswith(d.rstrip('/') + '/') for d in include)
+    return True
+
+
+def get_changed_files(repo, rev0, rev1, include=[], exts=SRC_EXTS):
+    # returns (paths in rev0, paths in rev1)
+    out = git(repo, 'diff-tree', '-r', '-M', '-z', '--no-commit-id', '--name-status',
+              rev0, rev1)
+    fields = out.decode('utf-8').split('\0')
+    paths0 = []
+    paths1 = []
+    i = 0
+    while i < len(fields) and fields[i]:
+        st = fields[i][0]
+        if st in ('R', 'C'):
+            p0, p1 = fields[i+1], fields[i+2]
+            i += 3
+        else:
+            p0 = p1 = fields[i+1]
+            i += 2
+        if st in ('M', 'T', 'R', 'D') and is_target(p0, include, exts):
+            paths0.append(p0)
+        if st in ('M', 'T', 'R', 'C', 'A') and is_target(p1, include, exts):
+            paths1.append(p1)
+    return paths0, paths1
+
+
+def export_files(repo, rev, paths, dest):
+    # writes blobs rev:path into dest/path via a single "git cat-file --batch"
+    if not paths:
+        ensure_dir(dest)
+        return 0
+    input = ''.join(f'{rev}:{p}\n' for p in paths).encode('utf-8')
+    out = git(repo, 'cat-file', '--batch', input=input)
+    pos = 0
+    count = 0
+    for path in paths:
+        eol = out.index(b'\n', pos)
+        header = out[pos:eol].decode('utf-8').split()
+        pos = eol + 1
+        if len(header) < 3 or header[1] != 'blob':
+            logger.warning(f'not found: {rev}:{path}')
+            continue
+        size = int(header[2])
+        data = out[pos:pos+size]
+        pos += size + 1
+        p = os.path.join(dest, path)
+        ensure_dir(os.path.dirname(p))
+        with open(p, 'wb') as f:
+            f.write(data)
+        count += 1
+    return count
+
+
+def export_tree(repo, rev, dest, include=[]):
+    ensure_dir(dest)
+    archive = subprocess.Popen(['git', '-C', repo, 'archive', rev] + include,
+                               stdout=subprocess.PIPE)
+    rc = subprocess.run(['tar', '-x', '-C', dest], stdin=archive.stdout).returncode
+    archive.stdout.close()
+    if archive.wait() != 0 or rc != 0:
+        raise RuntimeError(f'failed to export {rev} into "{dest}"')
+
+
+def materialize_commit(repo, cid, out_dir, include=[], full=False):
+    # creates out_dir/CID-before and out_dir/CID-after
+    dir_before = os.path.join(out_dir, f'{cid}-before')
+    dir_after = os.path.join(out_dir, f'{cid}-after')
+    for d in (dir_before, dir_after):
+        rmdir(d)
+    parent = get_parent(repo, cid)
+    if full:
+        export_tree(repo, parent, dir_before, include)
+        export_tree(repo, cid, dir_after, include)
+        logger.info(f'{cid}: exported whole trees')
+    else:
+        paths0, paths1 = get_changed_files(repo, parent, cid, include)
+        n0 = export_files(repo, parent, paths0, dir_before)
+        n1 = export_files(repo, cid, paths1, dir_after)
+        logger.info(f'{cid}: exported {n0} -> {n1} files')
+    return dir_before, dir_after
+
+
+def get_commits(repo, rev_range):
+    # returns [BASE, C1, ..., CN] for rev_range "BASE..CN" along first parents
+    base, _, last = rev_range.partition('..')
+    if not base or not last:
+        raise ValueError(f'invalid range: {rev_range}')
+    base = git(repo, 'rev-parse', base).decode('utf-8').strip()
+    out = git(repo, 'rev-list', '--reverse', '--first-parent', f'{base}..{last}')
+    commits = [base] + out.decode('utf-8').split()
+    return commits
+
+
+def get_range_pair_dir(out_dir, c0, c1):
+    return os.path.join(out_dir, c1)
+
+
+def materialize_range(repo, commits, out_dir, include=[], full=False):
+    # creates out_dir/C1/C0 and out_dir/C1/C1 for each pair (C0, C1) of consecutive commits
+    # only the paths changed by a pair are exported for it, so a commit shared by
+    # two pairs is exported (and parsed by diffast) once for each of them
+    dirs = []
+    for c0, c1 in zip(commits, commits[1:]):
+        d = get_range_pair_dir(out_dir, c0, c1)
+        rmdir(d)
+        d0 = os.path.join(d, c0)
+        d1 = os.path.join(d, c1)
+        if full:
+            export_tree(repo, c0, d0, include)
+            export_tree(repo, c1, d1, include)
+            logger.info(f'{c1}: exported whole trees')
+        else:
+            paths0, paths1 = get_changed_files(repo, c0, c1, include)
+            n0 = export_files(repo, c0, paths0, d0)
+            n1 = export_files(repo, c1, paths1, d1)
+            logger.info(f'{c1}: exported {n0} -> {n1} files')
+        dirs.append(d)
+    return dirs
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+'''
+  manifest.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import hashlib
+import threading
+import logging
+
+from .misc import read_json, get_timestamp
+
+logger = logging.getLogger()
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def fingerprint(*objs):
+    s = json.dumps(objs, sort_keys=True, default=str)
+    fp = hashlib.sha1(s.encode('utf-8')).hexdigest()
+    return fp
+
+
+def fingerprint_files(dpath, exts=None):
+    entries = []
+    if os.path.isdir(dpath):
+        for root, dirs, files in os.walk(dpath):
+            dirs.sort()
+            for fn in sorted(files):
+                if exts is not None and not any(fn.endswith(x) for x in exts):
+                    continue
+                p = os.path.join(root, fn)
+                try:
+                    st = os.stat(p)
+                    entries.append((os.path.relpath(p, dpath), st.st_size, st.st_mtime_ns))
+                except OSError as e:
+                    logger.warning(f'{e}')
+    return fingerprint(entries)
+
+
+class Manifest(object):
+    # records are always written, but reused only if resume=True
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume
+        self._lock = threading.Lock()
+        self._tbl = {}
+        if resume and os.path.exists(path):
+            d = read_json(path)
+            if d is not None:
+                self._tbl = d
+        logger.info(f'manifest: "{path}" ({len(self._tbl)} stages recorded)')
+
+    def is_done(self, stage, fp):
+        b = False
+        if self.resume:
+            with self._lock:
+                try:
+                    b = self._tbl[stage]['fingerprint'] == fp
+                except KeyError:
+                    pass
+        return b
+
+    def get_undone(self, stages, fps):
+        # indices of the stages not done with the fingerprints
+        return [i for i, (stage, fp) in enumerate(zip(stages, fps))
+                if not self.is_done(stage, fp)]
+
+    def has(self, stage):
+        with self._lock:
+            return stage in self._tbl
+
+    def get_data(self, stage):
+        with self._lock:
+            try:
+                return self._tbl[stage].get('data', None)
+            except KeyError:
+                return None
+
+    def set_done(self, stage, fp, data=None):
+        with self._lock:
+            d = {'fingerprint': fp, 'time': get_timestamp()}
+            if data is not None:
+                d['data'] = data
+            self._tbl[stage] = d
+            self._dump()
+
+    def invalidate(self, *stages):
+        with self._lock:
+            modified = False
+            for stage in stages:
+                if stage in self._tbl:
+                    del self._tbl[stage]
+                    modified = True
+            if modified:
+                self._dump()
+
+    def _dump(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._tbl, f, indent=1)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning(f'failed to write "{self.path}": {e}')
@@ -1,12 +1,69 @@
 #!/usr/bin/env python3
 
 import os.path
+import re
+import shutil
+import tempfile
+import logging
 
 from cca.ccautil.materialize_fact import main, Materializer, VIRTUOSO_PORT, VIRTUOSO_PW
 from cca.ccautil.siteconf import CCA_HOME
+from cca.ccautil.ns import FB_NS
+from cca.ccautil import sparql
+
+from .querydeps import get_deps, get_needed, get_reads, run_dag, INFERENCE_PAT
+
+logger = logging.getLogger()
 
 QUERY_DIR = os.path.join(CCA_HOME, 'queries', 'materialize')
 
+MAX_ITER = 5  # max rounds of JAVA_ITER_QUERIES
+
+# query -> queries of the same block it depends on (overrides derived dependencies)
+QUERY_DEPS = {}
+
+COUNT_QUERY = 'SELECT (COUNT(*) AS ?n) FROM <%(graph_uri)s> WHERE { ?s ?p ?o }'
+
+# localized materialization:
+# once SCOPE_AFTER has run, modified, added and removed type declarations are
+# collected into the scope graph and LOCAL_QUERIES are restricted to entities in them
+
+SCOPE_AFTER = 'stable_mapping.rq'
+
+SCOPE_SUFFIX = '/scope'
+
+CLEAR_SCOPE_QUERY = 'CLEAR GRAPH <%(scope_uri)s>'
+
+SCOPE_QUERY = '''DEFINE input:inference "ont.cpi"
+PREFIX chg:  <http://codinuum.com/ontologies/2012/10/primitive-change#>
+PREFIX java: <http://codinuum.com/ontologies/2012/10/java-entity#>
+
+INSERT {
+  GRAPH <%(scope_uri)s> {
+    ?tdecl a java:TypeDeclaration .
+  }
+}
+WHERE {
+  GRAPH <%(graph_uri)s> {
+    ?tdecl a java:TypeDeclaration .
+    FILTER (EXISTS { ?tdecl chg:modified [] } ||
+            EXISTS { [] chg:modified ?tdecl } ||
+            NOT EXISTS {
+              { ?tdecl chg:mappedTo [] } UNION { [] chg:mappedTo ?tdecl }
+            })
+  }
+}
+'''
+
+# put at the top of the WHERE clause of LOCAL_QUERIES, var being the subject inserted
+LOCAL_PAT = '''
+  %(var)s <http://codinuum.com/ontologies/2012/10/java-entity#inTypeDeclaration> ?scope_tdecl__ .
+  FILTER EXISTS { GRAPH <%(scope_uri)s> { ?scope_tdecl__ a [] } }
+'''
+
+INS_SUBJ_PAT = re.compile(r'\bINSERT\s*\{\s*(GRAPH\s+\S+\s*\{\s*)?(?P<var>\?\w+)', re.I)
+WHERE_OPEN_PAT = re.compile(r'\bWHERE\s*\{(\s*GRAPH\s+\S+\s*\{)?', re.I)
+
 JAVA_ITER_QUERIES = [
     'resolved_name.rq',
     'resolved_facc.rq',
@@ -43,82 +100,312 @@ JAVA_ITER_QUERIES = [
     # 'this_ivkx.rq',
 ]
 
+JAVA_PRE_QUERIES = [
+    'tdecl_in_srctree.rq',
+    'file_mapping.rq',
+    # 'stmt_level0.rq',
+    # 'stmt_level.rq',
+    # 'pruned_tdecl.rq',
+    # 'pruned_super_type.rq',
+    # 'pruned_method.rq',
+    # 'pruned_field.rq',
+    # 'pruned_field_access.rq',
+    # 'pruned_name.rq',
+    # 'pruned_enum_const.rq',
+    # 'pruned_invocation.rq',
+    # 'pruned_import.rq',
+    # 'pruned_param.rq',
+    # 'grafted_tdecl.rq',
+    # 'grafted_super_type.rq',
+    # 'grafted_method.rq',
+    # 'grafted_field.rq',
+    # 'grafted_field_access.rq',
+    # 'grafted_name.rq',
+    # 'grafted_enum_const.rq',
+    # 'grafted_invocation.rq',
+    # 'grafted_import.rq',
+    # 'grafted_param.rq',
+    'resolved_reftype.rq',
+    'resolved_tyvar.rq',
+    # 'resolved_type_ivk_pe.rq',
+    # 'resolved_type_ivk_ps.rq',
+    # 'resolved_type_ivk.rq',
+    # 'resolved_type_ivk_static.rq',
+    # 'class_hierarchy.rq',
+    # 'interface_hierarchy.rq',
+    # 'class_name_hierarchy.rq',
+    'resolved_enum_const.rq',
+    'resolved_facc0.rq',
+    'refers_to_decl.rq',
+    'tdecl_mapped_eq.rq',
+    'tdecl_modified.rq',
+    'stable_mapping.rq',
+    'return_reftype.rq',
+    'return_type.rq',
+    # 'reftype_of_new0.rq',
+    'declared_by_field0-0-0.rq',
+    'declared_by_field0-0-1.rq',
+    'declared_by_field0-0-2.rq',
+    'declared_by_field0-1.rq',
+    'declared_by_catch_param.rq',
+    'declared_by_for_header.rq',
+    # 'reftype_of_enum_const.rq',
+    # 'reftype_of_cast.rq',
+    'reftype_of_declared_var.rq',
+    'reftype_of_var_declared_by_param.rq',
+    'reftype_of_local_field_access.rq',
+    # 'type_of_enum_const.rq',
+    # 'type_of_cast.rq',
+    # 'type_of_literal.rq',
+    'type_of_declared_var.rq',
+    'type_of_var_declared_by_param.rq',
+    'type_of_local_field_access.rq',
+    'param_ty.rq',
+    'param_ty_name.rq',
+    # 'simple_ivk0.rq',
+    # 'super_ivk0.rq',
+    # 'this_ivk0.rq',
+    # 'new_ivk0.rq',
+]
+
+JAVA_POST_QUERIES = [
+    'declared_by_field2.rq',
+]
+
+# facts of entities (rather than of files or type declarations), localizable
+LOCAL_QUERIES = {
+    'return_reftype.rq',
+    'return_type.rq',
+    'declared_by_field0-0-0.rq',
+    'declared_by_field0-0-1.rq',
+    'declared_by_field0-0-2.rq',
+    'declared_by_field0-1.rq',
+    'declared_by_catch_param.rq',
+    'declared_by_for_header.rq',
+    'reftype_of_declared_var.rq',
+    'reftype_of_var_declared_by_param.rq',
+    'reftype_of_local_field_access.rq',
+    'type_of_declared_var.rq',
+    'type_of_var_declared_by_param.rq',
+    'type_of_local_field_access.rq',
+    'param_ty.rq',
+    'param_ty_name.rq',
+
+    'resolved_name.rq',
+    'resolved_facc.rq',
+    'reftype_of_field_access.rq',
+    'type_of_array_access.rq',
+    'type_of_field_access.rq',
+
+    'declared_by_field2.rq',
+}
+
+# used as is by main_() (three rounds of JAVA_ITER_QUERIES)
 QUERIES = {
-    'java': [
-        'tdecl_in_srctree.rq',
-        'file_mapping.rq',
-        # 'stmt_level0.rq',
-        # 'stmt_level.rq',
-        # 'pruned_tdecl.rq',
-        # 'pruned_super_type.rq',
-        # 'pruned_method.rq',
-        # 'pruned_field.rq',
-        # 'pruned_field_access.rq',
-        # 'pruned_name.rq',
-        # 'pruned_enum_const.rq',
-        # 'pruned_invocation.rq',
-        # 'pruned_import.rq',
-        # 'pruned_param.rq',
-        # 'grafted_tdecl.rq',
-        # 'grafted_super_type.rq',
-        # 'grafted_method.rq',
-        # 'grafted_field.rq',
-        # 'grafted_field_access.rq',
-        # 'grafted_name.rq',
-        # 'grafted_enum_const.rq',
-        # 'grafted_invocation.rq',
-        # 'grafted_import.rq',
-        # 'grafted_param.rq',
-        'resolved_reftype.rq',
-        'resolved_tyvar.rq',
-        # 'resolved_type_ivk_pe.rq',
-        # 'resolved_type_ivk_ps.rq',
-        # 'resolved_type_ivk.rq',
-        # 'resolved_type_ivk_static.rq',
-        # 'class_hierarchy.rq',
-        # 'interface_hierarchy.rq',
-        # 'class_name_hierarchy.rq',
-        'resolved_enum_const.rq',
-        'resolved_facc0.rq',
-        'refers_to_decl.rq',
-        'tdecl_mapped_eq.rq',
-        'tdecl_modified.rq',
-        'stable_mapping.rq',
-        'return_reftype.rq',
-        'return_type.rq',
-        # 'reftype_of_new0.rq',
-        'declared_by_field0-0-0.rq',
-        'declared_by_field0-0-1.rq',
-        'declared_by_field0-0-2.rq',
-        'declared_by_field0-1.rq',
-        'declared_by_catch_param.rq',
-        'declared_by_for_header.rq',
-        # 'reftype_of_enum_const.rq',
-        # 'reftype_of_cast.rq',
-        'reftype_of_declared_var.rq',
-        'reftype_of_var_declared_by_param.rq',
-        'reftype_of_local_field_access.rq',
-        # 'type_of_enum_const.rq',
-        # 'type_of_cast.rq',
-        # 'type_of_literal.rq',
-        'type_of_declared_var.rq',
-        'type_of_var_declared_by_param.rq',
-        'type_of_local_field_access.rq',
-        'param_ty.rq',
-        'param_ty_name.rq',
-        # 'simple_ivk0.rq',
-        # 'super_ivk0.rq',
-        # 'this_ivk0.rq',
-        # 'new_ivk0.rq',
-    ] + JAVA_ITER_QUERIES + JAVA_ITER_QUERIES + JAVA_ITER_QUERIES + [
-        'declared_by_field2.rq',
-    ],
+    'java': JAVA_PRE_QUERIES + JAVA_ITER_QUERIES * 3 + JAVA_POST_QUERIES,
 }
 
 
-def materialize(proj_id, pw=VIRTUOSO_PW, port=VIRTUOSO_PORT, conf=None):
-    m = Materializer(QUERY_DIR, QUERIES, proj_id, pw=pw, port=port, conf=conf)
-    rc = m.materialize()
+def count_triples(driver, proj_id):
+    n = None
+    for _, row in driver.query(COUNT_QUERY % {'graph_uri': FB_NS + proj_id}):
+        n = int(row['n'])
+    return n
+
+
+def read_query(name):
+    text = None
+    for d in (os.path.join(QUERY_DIR, 'java'), QUERY_DIR):
+        path = os.path.join(d, name)
+        if os.path.exists(path):
+            with open(path) as f:
+                text = f.read()
+            break
+    return text
+
+
+def select_queries(reads=None):
+    # (pre, iter, post) query lists restricted to those contributing to reads
+    # (names read by the queries to be served, None standing for "any")
+    blocks = (JAVA_PRE_QUERIES, JAVA_ITER_QUERIES, JAVA_POST_QUERIES)
+    if reads is None:
+        return blocks
+    names = JAVA_PRE_QUERIES + JAVA_ITER_QUERIES + JAVA_POST_QUERIES
+    needed = get_needed(names, {q: read_query(q) for q in names}, reads)
+    return tuple([q for q in b if q in needed] for b in blocks)
+
+
+def get_scope_uri(proj_id):
+    return FB_NS + proj_id + SCOPE_SUFFIX
+
+
+def make_scope(proj_id, pw=VIRTUOSO_PW, port=VIRTUOSO_PORT):
+    # returns the number of type declarations put into the scope graph
+    driver = sparql.get_driver('odbc', pw=pw, port=port)
+    params = {'graph_uri': FB_NS + proj_id, 'scope_uri': get_scope_uri(proj_id)}
+    driver.execute(CLEAR_SCOPE_QUERY % params)
+    driver.execute(SCOPE_QUERY % params)
+    return count_triples(driver, proj_id + SCOPE_SUFFIX)
+
+
+def localize(text, scope_uri):
+    # restricts the subjects inserted by a query to the entities in the scope,
+    # returns None if the query cannot be restricted
+    if text is None or not INFERENCE_PAT.search(text):  # inTypeDeclaration has subproperties
+        return None
+    m = INS_SUBJ_PAT.search(text)
+    if m is None:
+        return None
+    w = WHERE_OPEN_PAT.search(text, m.end())
+    if w is None:
+        return None
+    pat = LOCAL_PAT % {'var': m.group('var'), 'scope_uri': scope_uri}
+    return text[:w.end()] + pat + text[w.end():]
+
+
+def write_local_queries(queries, query_dir, scope_uri):
+    # writes queries into query_dir, LOCAL_QUERIES being localized
+    # returns False if some query is not found
+    java_dir = os.path.join(query_dir, 'java')
+    os.makedirs(java_dir, exist_ok=True)
+    nlocal = 0
+    for q in queries:
+        text = read_query(q)
+        if text is None:
+            logger.warning(f'not found: {q}')
+            return False
+        if q in LOCAL_QUERIES:
+            t = localize(text, scope_uri)
+            if t is None:
+                logger.warning(f'cannot localize {q}')
+            else:
+                text = t
+                nlocal += 1
+        with open(os.path.join(java_dir, q), 'w') as f:
+            f.write(text)
+    logger.info(f'{nlocal} queries localized')
+    return True
+
+
+def run_queries(queries, proj_id, pw=VIRTUOSO_PW, port=VIRTUOSO_PORT, conf=None, njobs=1,
+                qprof=None, block=None, round=None, query_dir=QUERY_DIR):
+    # with njobs > 1, independent queries run concurrently, each over its own connection
+    # qprof: QueryProfiler to record each query run
+    if not queries:
+        return 0
+
+    def run(q):
+        m = Materializer(query_dir, {'java': [q]}, proj_id, pw=pw, port=port, conf=conf)
+        return m.materialize()
+
+    if njobs <= 1 or len(queries) <= 1:
+        if qprof is None:
+            m = Materializer(query_dir, {'java': queries}, proj_id, pw=pw, port=port, conf=conf)
+            rc = m.materialize()
+            return rc
+
+        driver = sparql.get_driver('odbc', pw=pw, port=port)
+
+        def count():
+            return count_triples(driver, proj_id)
+
+        for q in queries:
+            rc = qprof.run(q, lambda: run(q), count=count, block=block, round=round)
+            if rc != 0:
+                return rc
+        return 0
+
+    deps = get_deps(queries, {q: read_query(q) for q in queries}, QUERY_DEPS)
+    for q in queries:
+        logger.debug(f'{q} <- {sorted(deps[q])}')
+
+    if qprof is not None:
+        def run_p(q):
+            return qprof.run(q, lambda: run(q), exclusive=False, block=block, round=round)
+        return run_dag(queries, deps, njobs, run_p)
+
+    return run_dag(queries, deps, njobs, run)
+
+
+def run_blocks(pre_queries, iter_queries, post_queries, proj_id, pw, port, conf,
+               max_iter, rounds, njobs, qprof, query_dir):
+    rc = run_queries(pre_queries, proj_id, pw=pw, port=port, conf=conf, njobs=njobs,
+                     qprof=qprof, block='pre', query_dir=query_dir)
+    if rc != 0:
+        return rc
+
+    if iter_queries:
+        driver = sparql.get_driver('odbc', pw=pw, port=port)
+        n0 = count_triples(driver, proj_id)
+        for i in range(max_iter):
+            rc = run_queries(iter_queries, proj_id, pw=pw, port=port, conf=conf,
+                             njobs=njobs, qprof=qprof, block='iter', round=i+1,
+                             query_dir=query_dir)
+            if rc != 0:
+                return rc
+            n1 = count_triples(driver, proj_id)
+            ninserted = n1 - n0
+            logger.info(f'round {i+1}: {ninserted} triples inserted')
+            if rounds is not None:
+                rounds.append(ninserted)
+            if ninserted == 0:
+                break
+            n0 = n1
+        else:
+            logger.warning(f'no fixpoint reached in {max_iter} rounds')
+
+    rc = run_queries(post_queries, proj_id, pw=pw, port=port, conf=conf, njobs=njobs,
+                     qprof=qprof, block='post', query_dir=query_dir)
+    return rc
+
+
+def materialize(proj_id, pw=VIRTUOSO_PW, port=VIRTUOSO_PORT, conf=None,
+                max_iter=MAX_ITER, rounds=None, njobs=1, qprof=None, reads=None,
+                localized=False, scope=None):
+    # JAVA_ITER_QUERIES are repeated until a round inserts no triples (up to max_iter)
+    # rounds: list to receive the number of triples inserted by each round
+    # reads: names read by the queries to be served (see select_queries)
+    # localized: restrict LOCAL_QUERIES to modified type declarations
+    # scope: dict to receive the number of type declarations in the scope
+    if localized and reads is not None:
+        r = get_reads(SCOPE_QUERY)
+        reads = None if r is None else reads | r
+    pre_queries, iter_queries, post_queries = select_queries(reads)
+    if reads is not None:
+        nqueries = len(pre_queries) + len(iter_queries) + len(post_queries)
+        logger.info(f'{nqueries} queries selected')
+
+    if not localized:
+        return run_blocks(pre_queries, iter_queries, post_queries, proj_id, pw, port, conf,
+                          max_iter, rounds, njobs, qprof, QUERY_DIR)
+
+    i = JAVA_PRE_QUERIES.index(SCOPE_AFTER)
+    pre0 = [q for q in pre_queries if JAVA_PRE_QUERIES.index(q) <= i]
+    pre1 = [q for q in pre_queries if JAVA_PRE_QUERIES.index(q) > i]
+    rc = run_queries(pre0, proj_id, pw=pw, port=port, conf=conf, njobs=njobs,
+                     qprof=qprof, block='pre')
+    if rc != 0:
+        return rc
+
+    query_dir = QUERY_DIR
+    tmp_dir = None
+    ntdecls = make_scope(proj_id, pw=pw, port=port)
+    logger.info(f'{ntdecls} type declarations in scope')
+    if scope is not None:
+        scope['ntdecls'] = ntdecls
+    if not ntdecls:
+        logger.warning('empty scope, materializing for the whole graph')
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='materialize-')
+        if write_local_queries(pre1 + iter_queries + post_queries, tmp_dir,
+                               get_scope_uri(proj_id)):
+            query_dir = tmp_dir
+    try:
+        rc = run_blocks(pre1, iter_queries, post_queries, proj_id, pw, port, conf,
+                        max_iter, rounds, njobs, qprof, query_dir)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
     return rc
 
 
@@ -23,9 +23,9 @@ __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 import os
 import json
 import shutil
+import subprocess
 from datetime import datetime
 from uuid import uuid4
-import psutil
 import logging
 
 ###
@@ -83,6 +83,21 @@ def rmdir(path):
     return stat
 
 
+def clone_file(src, dst):
+    # copies src into dst sharing blocks (reflink) where the filesystem allows
+    stat = 0
+    try:
+        subprocess.run(['cp', '--reflink=auto', src, dst], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except Exception:
+        try:
+            shutil.copyfile(src, dst)
+        except Exception as e:
+            logger.warning(f'failed to copy "{src}" into "{dst}": {e}')
+            stat = 1
+    return stat
+
+
 def ensure_dir(d):
     b = True
     if not os.path.exists(d):
@@ -120,26 +135,6 @@ def clear_dirs(dirs):
     return stat
 
 
-def is_virtuoso_running(port):
-    b = False
-    for p in psutil.process_iter():
-        try:
-            if p.name() == 'virtuoso-t':
-                try:
-                    for conn in p.connections(kind='tcp'):
-                        if conn.laddr.port == port:
-                            b = True
-                            break
-                    if b:
-                        break
-                except Exception as e:
-                    logger.warning(f'{e}: port={port}')
-        except Exception as e:
-            logger.warning(f'{e}: port={port}')
-            pass
-    return b
-
-
 def read_json(data_path):
     d = None
     try:
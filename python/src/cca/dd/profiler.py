@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+'''
+  profiler.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+import logging
+
+from .common import FB_DIR
+from .misc import get_timestamp
+from .supervisor import Supervisor
+
+logger = logging.getLogger()
+
+PROFILE_FILE_NAME = 'rrj.profile.json'
+
+
+def get_rusage():
+    ru_self = resource.getrusage(resource.RUSAGE_SELF)
+    ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    d = {
+        'cpu_self': ru_self.ru_utime + ru_self.ru_stime,
+        'cpu_children': ru_children.ru_utime + ru_children.ru_stime,
+        'maxrss_self_kb': ru_self.ru_maxrss,
+        'maxrss_children_kb': ru_children.ru_maxrss,
+    }
+    return d
+
+
+def get_proc_status(pid, keys):
+    tbl = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                k, _, v = line.partition(':')
+                if k in keys:
+                    tbl[k] = int(v.split()[0])
+    except Exception:
+        pass
+    return tbl
+
+
+def get_virtuoso_mem(pid):
+    d = {}
+    if pid is not None:
+        st = get_proc_status(pid, ('VmRSS', 'VmHWM'))
+        if 'VmRSS' in st:
+            d['virtuoso_rss_kb'] = st['VmRSS']
+        if 'VmHWM' in st:
+            d['virtuoso_maxrss_kb'] = st['VmHWM']
+    return d
+
+
+def count_files(dpath, exts):
+    nfiles = 0
+    nbytes = 0
+    if os.path.isdir(dpath):
+        for root, dirs, files in os.walk(dpath):
+            for fn in files:
+                if any(fn.endswith(x) for x in exts):
+                    try:
+                        nbytes += os.path.getsize(os.path.join(root, fn))
+                        nfiles += 1
+                    except OSError:
+                        pass
+    return nfiles, nbytes
+
+
+class Profiler(object):
+    def __init__(self, out_file, proj_id=None, port=None):
+        self.out_file = out_file
+        self.port = port
+        self._supervisor = None
+        if proj_id is not None and port is not None:
+            self._supervisor = Supervisor(os.path.join(FB_DIR, proj_id), port=port)
+        self._lock = threading.Lock()
+        self._tbl = {
+            'proj_id': proj_id,
+            'start': get_timestamp(),
+            'stages': [],
+        }
+
+    @contextlib.contextmanager
+    def stage(self, name, **extra):
+        d = {'stage': name, 'start': get_timestamp()}
+        d.update(extra)
+        ru0 = get_rusage()
+        t0 = time.monotonic()
+        try:
+            yield d
+        finally:
+            d['wall'] = time.monotonic() - t0
+            ru1 = get_rusage()
+            d['cpu_self'] = ru1['cpu_self'] - ru0['cpu_self']
+            d['cpu_children'] = ru1['cpu_children'] - ru0['cpu_children']
+            d['maxrss_self_kb'] = ru1['maxrss_self_kb']
+            d['maxrss_children_kb'] = ru1['maxrss_children_kb']
+            if self._supervisor is not None:
+                d.update(get_virtuoso_mem(self._supervisor.get_pid()))
+            logger.info(f'{name}: {d["wall"]:.2f}s (cpu={d["cpu_self"]:.2f}s'
+                        f'+{d["cpu_children"]:.2f}s)')
+            self.add(d)
+
+    def add(self, d):
+        with self._lock:
+            self._tbl['stages'].append(d)
+            self._tbl['end'] = get_timestamp()
+            self._dump()
+
+    def _dump(self):
+        tmp = self.out_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._tbl, f, indent=1)
+            os.replace(tmp, self.out_file)
+        except Exception as e:
+            logger.warning(f'failed to write "{self.out_file}": {e}')
+
+
+class NullProfiler(object):
+    @contextlib.contextmanager
+    def stage(self, name, **extra):
+        yield {}
+
+    def add(self, d):
+        pass
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+'''
+  qprofile.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import csv
+import time
+import shutil
+import threading
+import logging
+
+from .common import LOG_DIR
+from .misc import ensure_dir
+
+logger = logging.getLogger()
+
+QPROFILE_FILE_NAME = 'materialize.profile.csv'
+VPROF_DIR_NAME = 'materialize.vprof'
+VPROF_FILE_NAME = 'virtprof.out'  # written by virtuoso on prof_enable(0)
+
+FIELDS = ['block', 'round', 'query', 'wall', 'ninserted', 'rc', 'vprof']
+
+
+class QueryProfiler(object):
+    # records wall time, inserted triples and virtuoso's profile of each query run
+    def __init__(self, out_dir, supervisor=None):
+        self.out_file = os.path.join(out_dir, QPROFILE_FILE_NAME)
+        self.vprof_dir = os.path.join(out_dir, VPROF_DIR_NAME)
+        self.supervisor = supervisor
+        self.rows = []
+        self._lock = threading.Lock()
+        ensure_dir(self.vprof_dir)
+
+    def run(self, query, run, count=None, exclusive=True, block=None, round=None):
+        # counts and virtuoso's profile are taken only when the query runs alone
+        sv = self.supervisor if exclusive else None
+        if sv is not None:
+            sv.exec_sql('prof_enable(1);')
+        n0 = count() if exclusive and count is not None else None
+        t0 = time.monotonic()
+        rc = run()
+        wall = time.monotonic() - t0
+        row = {
+            'block': block,
+            'round': round,
+            'query': query,
+            'wall': f'{wall:.3f}',
+            'ninserted': None,
+            'rc': rc,
+            'vprof': None,
+        }
+        if n0 is not None:
+            row['ninserted'] = count() - n0
+        if sv is not None:
+            sv.exec_sql('prof_enable(0);')
+            row['vprof'] = self.save_vprof(block, round, query)
+        logger.info(f'{query}: {wall:.2f}s, {row["ninserted"]} triples inserted')
+        with self._lock:
+            self.rows.append(row)
+            self.dump()
+        return rc
+
+    def save_vprof(self, block, round, query):
+        src = os.path.join(self.supervisor.fb_dir, VPROF_FILE_NAME)
+        if not os.path.exists(src):
+            return None
+        name = '-'.join(str(x) for x in (block, round, query) if x is not None)
+        dst = os.path.join(self.vprof_dir, f'{name}.txt')
+        try:
+            shutil.move(src, dst)
+        except Exception as e:
+            logger.warning(f'{e}')
+            return None
+        return os.path.relpath(dst, os.path.dirname(self.out_file))
+
+    def dump(self):
+        with open(self.out_file, 'w', newline='') as f:
+            w = csv.DictWriter(f, fieldnames=FIELDS)
+            w.writeheader()
+            for row in self.rows:
+                w.writerow(row)
+
+
+def read_profile(path):
+    # query -> (total wall, total inserted triples, number of runs)
+    tbl = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            q = row['query']
+            wall, nins, nruns = tbl.get(q, (0.0, 0, 0))
+            wall += float(row['wall'])
+            if row['ninserted']:
+                nins += int(row['ninserted'])
+            tbl[q] = (wall, nins, nruns + 1)
+    return tbl
+
+
+def get_profile_path(x):
+    # x: path of a profile or project id
+    if os.path.isfile(x):
+        return x
+    return os.path.join(LOG_DIR, 'rrj', x, QPROFILE_FILE_NAME)
+
+
+def compare(names, top=None, out=None):
+    tbls = [read_profile(get_profile_path(x)) for x in names]
+    queries = set()
+    for tbl in tbls:
+        queries.update(tbl.keys())
+
+    def key(q):
+        return max(tbl.get(q, (0.0,))[0] for tbl in tbls)
+
+    queries = sorted(queries, key=key, reverse=True)
+    if top is not None:
+        queries = queries[:top]
+
+    header = ['query']
+    for x in names:
+        header += [f'{x}:wall', f'{x}:inserted', f'{x}:runs']
+    rows = []
+    for q in queries:
+        row = [q]
+        for tbl in tbls:
+            if q in tbl:
+                wall, nins, nruns = tbl[q]
+                row += [f'{wall:.2f}', str(nins), str(nruns)]
+            else:
+                row += ['-', '-', '-']
+        rows.append(row)
+
+    if out is not None:
+        with open(out, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(header)
+            for row in rows:
+                w.writerow(row)
+    else:
+        widths = [max(len(r[i]) for r in [header] + rows) for i in range(len(header))]
+        for r in [header] + rows:
+            print('  '.join(c.ljust(w) if i == 0 else c.rjust(w)
+                            for i, (c, w) in enumerate(zip(r, widths))))
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(description='Compare materialization query profiles of projects',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('profiles', metavar='PROJ_ID|CSV', type=str, nargs='+',
+                        help=f'project id (LOG_DIR/rrj/PROJ_ID/{QPROFILE_FILE_NAME} is read)'
+                        ' or path of a profile')
+
+    parser.add_argument('-n', '--top', dest='top', metavar='N', type=int, default=None,
+                        help='show only N slowest queries')
+
+    parser.add_argument('-o', '--out', dest='out', metavar='CSV_FILE', default=None,
+                        help='write the comparison into CSV_FILE')
+
+    args = parser.parse_args()
+
+    compare(args.profiles, top=args.top, out=args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+'''
+  querydeps.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger()
+
+COMMENT_PAT = re.compile(r'(^|\s)#[^\n]*')
+DECL_PAT = re.compile(r'^\s*(PREFIX|BASE|DEFINE)\b[^\n]*$', re.I | re.M)
+INSERT_PAT = re.compile(r'\bINSERT\b', re.I)
+WHERE_PAT = re.compile(r'\bWHERE\b', re.I)
+INFERENCE_PAT = re.compile(r'input:inference', re.I)
+IRI_PAT = re.compile(r'<[^<>\s]*>')
+GRAPH_PAT = re.compile(r'\b(GRAPH|FROM(\s+NAMED)?)\s+(<[^<>\s]*>|\S+:\S*)', re.I)
+PROJ_PAT = re.compile(r'\bSELECT\b[^{]*?(?=\bWHERE\b|\{)|\b(GROUP|ORDER)\s+BY\b[^{}]*', re.I)
+STRING_PAT = re.compile(r'"([^"\\]|\\.)*"|\'([^\'\\]|\\.)*\'')
+PNAME_PAT = re.compile(r'(?<![\w?$:/#.-])[A-Za-z][\w-]*:[A-Za-z_][\w-]*')
+TYPE_PNAMES = {'rdf:type', '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'}
+
+# a predicate given by a variable
+VAR_PRED_PAT = re.compile(r'(^|[\s;\[])\?\w+\s+\?\w+\s+[^\s.;,}\)]')
+# a class given by a variable or by a name
+VAR_CLASS_PAT = re.compile(r'(?<![\w?$])(a|rdf:type)\s+\?\w+')
+CLASS_PAT = re.compile(r'(?<![\w?$])(a|rdf:type)\s+(<|[A-Za-z][\w-]*:)')
+
+ANY_CLASS = 'a ?'  # stands for rdf:type triples of any class
+
+
+def get_names(text):
+    # predicates and classes (IRIs or prefixed names) that occur in text
+    names = set(IRI_PAT.findall(text))
+    names.update(PNAME_PAT.findall(IRI_PAT.sub(' ', text)))
+    names.difference_update(TYPE_PNAMES)
+    return names
+
+
+def get_part_names(text, write=False):
+    # names read (or written) by a query part, None standing for "any"
+    if VAR_PRED_PAT.search(text):
+        return None
+    names = get_names(text)
+    if VAR_CLASS_PAT.search(text):
+        if write:
+            return None
+        names.add(ANY_CLASS)
+    elif write and CLASS_PAT.search(text):
+        names.add(ANY_CLASS)
+    return names
+
+
+def strip(text):
+    # removes literals, comments, declarations, graph names and projections
+    text = DECL_PAT.sub('', COMMENT_PAT.sub(r'\1', STRING_PAT.sub('""', text)))
+    return PROJ_PAT.sub(' ', GRAPH_PAT.sub(' ', text))
+
+
+def get_rw(text):
+    # returns (names read, names written), None standing for "any"
+    if text is None or INFERENCE_PAT.search(text):
+        return None, None
+    text = strip(text)
+    m = INSERT_PAT.search(text)
+    if m is None:
+        return None, set()
+    w = WHERE_PAT.search(text, m.end())
+    if w is None:
+        return None, None
+    ins = text[m.end():w.start()]
+    where = text[w.end():]
+    writes = get_part_names(ins, write=True)
+    reads = get_part_names(where)
+    return reads, writes
+
+
+def get_reads(text):
+    # names read by a (SELECT) query regardless of entailment, None standing for "any"
+    if text is None:
+        return None
+    text = strip(text)
+    w = WHERE_PAT.search(text)
+    if w is None:
+        return None
+    return get_part_names(text[w.end():])
+
+
+def overlaps(xs, ys):
+    if xs is None:
+        return ys is None or len(ys) > 0
+    if ys is None:
+        return len(xs) > 0
+    return not xs.isdisjoint(ys)
+
+
+def get_deps(names, text_tbl, declared={}):
+    # name -> set of names preceding it in the list that it must wait for
+    # declared dependencies take precedence over those derived from the query texts
+    rw_tbl = {x: get_rw(text_tbl.get(x, None)) for x in names}
+    deps = {}
+    for j, y in enumerate(names):
+        if y in declared:
+            deps[y] = set(declared[y]) & set(names[:j])
+            continue
+        ry, wy = rw_tbl[y]
+        deps[y] = set()
+        for x in names[:j]:
+            rx, wx = rw_tbl[x]
+            if overlaps(wx, ry) or overlaps(rx, wy):
+                deps[y].add(x)
+    return deps
+
+
+def get_needed(names, text_tbl, reads):
+    # names of the queries that contribute to reads (directly or transitively), in order
+    rw_tbl = {x: get_rw(text_tbl.get(x, None)) for x in names}
+    needed = set()
+    changed = True
+    while changed:
+        changed = False
+        for x in names:
+            if x in needed:
+                continue
+            rx, wx = rw_tbl[x]
+            if overlaps(wx, reads):
+                needed.add(x)
+                changed = True
+                if reads is not None:
+                    reads = None if rx is None else reads | rx
+    return [x for x in names if x in needed]
+
+
+def run_dag(names, deps, njobs, run):
+    # runs run(name) for names concurrently respecting deps, returns nonzero on failure
+    done = set()
+    pending = list(names)
+    running = {}
+    rc = 0
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        while pending or running:
+            for x in [x for x in pending if deps[x] <= done]:
+                pending.remove(x)
+                running[executor.submit(run, x)] = x
+            if not running:
+                logger.error(f'unsatisfiable dependencies: {pending}')
+                return 1
+            finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for f in finished:
+                x = running.pop(f)
+                r = f.result()
+                if r != 0:
+                    logger.error(f'failed to run {x}')
+                    rc = r
+                    pending = []
+                done.add(x)
+    return rc
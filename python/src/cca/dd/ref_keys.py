@@ -20,9 +20,13 @@
 
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
+import os
 import re
 import json
+import threading
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from cca.ccautil.ns import FB_NS, NS_TBL
 from cca.ccautil import sparql
@@ -35,11 +39,15 @@ from .common import EXTRACT_VARIABLE, INLINE_VARIABLE
 from .common import get_type_sig as _get_type_sig
 from .ref_key_queries import QUERY_TBL, DTOR_QUERY
 from .ref import Ref, Desc
+from .misc import read_json
+from .virtuoso_ini import RESULT_SET_MAX_ROWS
+from . import dtor_index
 
 logger = logging.getLogger()
 
 
 VER_PAT = re.compile(r'^(?P<cid>[0-9a-f]+)-before$')
+VER_SUFFIX_PAT = re.compile(r'-(before|after)$')
 MSIG_PAT = re.compile(r'^\((?P<ptys>(.+)?)\)(?P<rty>.+)$')
 TYSIG_PAT = re.compile(r'^L(?P<ty>.+);$')
 
@@ -50,12 +58,189 @@ for k, v in SIG_TBL.items():
 
 MAX_VARS = 4
 
+PAGE_SIZE = RESULT_SET_MAX_ROWS // 2  # rows per query, far from truncation
+KEY_VAR_PREFIX = 'key__'
+
+AUTO_PARTITION_PAIRS = 8  # FBs with as many version pairs are dumped per partition
+
+VER_PAIRS_QUERY = '''PREFIX ver: <%(ver_ns)s>
+SELECT DISTINCT ?ver ?ver_
+WHERE {
+GRAPH <%(graph_uri)s> {
+  ?ver ver:next ?ver_ .
+}
+}
+'''
+
+SUBQUERY_PAT = re.compile(r'\bSELECT\b(?P<proj>[^{]*?)\bWHERE\s*\{(\s*GRAPH\s+\S+\s*\{)?', re.I)
+
 
 def get_cid(ver):
     cid = VER_PAT.sub(r'\g<cid>', get_localname(ver))
     return cid
 
 
+def get_cid_of_ver_name(vname):
+    return VER_SUFFIX_PAT.sub('', vname)
+
+
+def get_before_tbl(ver_tbl):
+    # version name -> cid of the pair whose before-version it is
+    tbl = {}
+    for v, aliases in ver_tbl.items():
+        for a in aliases:
+            if a.endswith('-before'):
+                tbl[v] = get_cid_of_ver_name(a)
+    return tbl
+
+
+def bind_vars(query, binding):
+    # binds variables (name -> IRI) in every (sub)query projecting them
+    def repl(m):
+        vs = [v for v in binding if re.search(rf'\?{v}\b', m.group('proj'))]
+        values = ''.join(f'\n  VALUES ?{v} {{ <{binding[v]}> }}' for v in vs)
+        return m.group(0) + values
+    return SUBQUERY_PAT.sub(repl, query)
+
+
+def get_ver_pairs(driver, qtbl):
+    pairs = []
+    for _, row in driver.query(VER_PAIRS_QUERY % qtbl):
+        pairs.append((row['ver'], row['ver_']))
+    pairs.sort()
+    return pairs
+
+
+def literal(s):
+    s = s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    return f'"{s}"'
+
+
+def after(keys, last):
+    # condition for rows ordered after last by keys
+    conds = []
+    for i, k in enumerate(keys):
+        c = [f'?{x} = {literal(v)}' for x, v in zip(keys[:i], last[:i])]
+        c.append(f'?{k} > {literal(last[i])}')
+        conds.append('(' + ' && '.join(c) + ')')
+    return ' || '.join(conds)
+
+
+def paginate(query, page_size=PAGE_SIZE):
+    # returns (keys, f) where f(last) is the page of query following the row
+    # whose keys are last (the first page if None)
+    # rows are ordered by the strings of all the variables projected (keys),
+    # so that a page is found without evaluating the preceding ones
+    m = SUBQUERY_PAT.search(query)
+    vs = re.findall(r'\?(\w+)', m.group('proj'))
+    keys = [f'{KEY_VAR_PREFIX}{i}' for i in range(len(vs))]
+    proj = ' '.join(f'(COALESCE(STR(?{v}), "") AS ?{k})' for v, k in zip(vs, keys))
+    prologue = query[:m.start()]
+    body = query[m.start():m.end('proj')] + f'{proj}\n' + query[m.end('proj'):]
+    order = ' '.join(f'?{k}' for k in keys)
+
+    def f(last):
+        cond = '' if last is None else f'FILTER ({after(keys, last)})\n'
+        return (f'{prologue}SELECT *\nWHERE {{\n{{\n{body}}}\n{cond}}}\n'
+                f'ORDER BY {order}\nLIMIT {page_size}')
+
+    return keys, f
+
+
+def query_all(driver, query, page_size=PAGE_SIZE):
+    # yields every row of query, a page at a time
+    keys, get_page = paginate(query, page_size=page_size)
+    last = None
+    while True:
+        n = 0
+        for r in driver.query(get_page(last)):
+            n += 1
+            row = r[1]
+            last = [str(row.pop(k, '')) for k in keys]
+            yield r
+        if n < page_size:
+            break
+
+
+def use_partitions(driver, qtbl, partitioned):
+    # partitioned: None for partitioning large FBs only
+    if partitioned is None:
+        npairs = len(get_ver_pairs(driver, qtbl))
+        partitioned = npairs >= AUTO_PARTITION_PAIRS
+        logger.info(f'{npairs} version pairs: partitioned={partitioned}')
+    return partitioned
+
+
+def get_local_driver(local, method, pw, port):
+    # a connection per thread
+    driver = getattr(local, 'driver', None)
+    if driver is None:
+        driver = local.driver = sparql.get_driver(method, pw=pw, port=port)
+    return driver
+
+
+def ordered_map(f, xs, njobs=1):
+    # yields f(x) for xs in order, computing at most 2*njobs of them ahead
+    njobs = max(1, njobs)
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        futures = deque()
+        for x in xs:
+            futures.append(executor.submit(f, x))
+            if len(futures) >= 2 * njobs:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+class MapWriter(object):
+    # writes a JSON object entry by entry
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.tmp_file = f'{out_file}.{os.getpid()}.tmp'
+        self.keys = set()
+        self._f = None
+
+    def __enter__(self):
+        logger.info(f'dumping into "{self.out_file}"...')
+        self._f = open(self.tmp_file, 'w')
+        self._f.write('{')
+        return self
+
+    def write(self, key, value):
+        if self.keys:
+            self._f.write(', ')
+        self._f.write(f'{json.dumps(key)}: {json.dumps(value)}')
+        self.keys.add(key)
+
+    def write_old(self):
+        # keeps the entries of the existing file not written anew
+        if os.path.exists(self.out_file):
+            old_tbl = read_json(self.out_file)
+            if old_tbl:
+                logger.info(f'merging into "{self.out_file}" ({len(old_tbl)} cids)...')
+                for k, v in old_tbl.items():
+                    if k not in self.keys:
+                        self.write(k, v)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._f.write('}')
+        self._f.close()
+        if exc_type is None:
+            os.replace(self.tmp_file, self.out_file)
+        else:
+            os.remove(self.tmp_file)
+        return False
+
+
+def write_tbl(out_file, tbl, merge=False):
+    # entries of tbl, released as written, replace those of the same cids in out_file
+    with MapWriter(out_file) as w:
+        for cid in list(tbl.keys()):
+            w.write(cid, tbl.pop(cid))
+        if merge:
+            w.write_old()
+
+
 def get_uqn(fqn):
     uqn = fqn
     if fqn:
@@ -390,8 +575,45 @@ PROC_TBL = {
 }
 
 
+def get_query_tbl(targets=None):
+    # QUERY_TBL restricted to targets (refactoring types)
+    if targets is None:
+        return QUERY_TBL
+    return {ref: q for ref, q in QUERY_TBL.items() if ref in targets}
+
+
+def get_canon(d):
+    # hashable form of a dict, equal for equal dicts
+    return tuple(sorted((k, get_canon(v) if isinstance(v, dict) else v) for k, v in d.items()))
+
+
+def add_ref(tbl, seen, refty, cid, r):
+    # seen: set of (cid, refty, canonical key dict) already added
+    key = r.key
+    logger.debug(f'key="{key}" cid={cid}')
+    try:
+        rtbl = tbl[cid]
+    except KeyError:
+        rtbl = {}
+        tbl[cid] = rtbl
+    try:
+        rl = rtbl[refty]
+    except KeyError:
+        rl = []
+        rtbl[refty] = rl
+    rd = r.to_dict()
+    k = (cid, refty, get_canon(rd))
+    if k not in seen:
+        seen.add(k)
+        rl.append(rd)
+
+
 def dump(proj_id, out_file,
-         method='odbc', pw=VIRTUOSO_PW, port=VIRTUOSO_PORT):
+         method='odbc', pw=VIRTUOSO_PW, port=VIRTUOSO_PORT,
+         cids=None, merge=False, ver_tbl=None, targets=None, partitioned=None, njobs=1):
+    # partitioned: run queries per version pair, njobs pairs at a time,
+    # writing the keys of each pair as soon as they are found
+    # (None for doing so if the FB has AUTO_PARTITION_PAIRS pairs or more)
 
     driver = sparql.get_driver(method, pw=pw, port=port)
 
@@ -400,44 +622,113 @@ def dump(proj_id, out_file,
     qtbl = NS_TBL.copy()
     qtbl['graph_uri'] = graph_uri
 
+    before_tbl = {}
+    if ver_tbl:
+        before_tbl = get_before_tbl(ver_tbl)
+
+    query_tbl = {ref: q % qtbl for ref, q in get_query_tbl(targets).items()}
+
+    if use_partitions(driver, qtbl, partitioned):
+        return dump_partitioned(driver, qtbl, query_tbl, out_file, method, pw, port,
+                                cids, merge, before_tbl, njobs)
+
     tbl = {}  # cid -> refty -> key list
+    seen = set()
 
-    for ref, _query in QUERY_TBL.items():
+    nrows = 0
+
+    for ref, query in query_tbl.items():
         logger.info(f'processing "{ref}"')
 
         refty = abbrev(ref)
-
-        query = _query % qtbl
         proc = PROC_TBL[ref]
 
         # print(f'***** {ref} *****')
         # print(query)
 
-        for _, row in driver.query(query):
+        for _, row in query_all(driver, query):
+            nrows += 1
             cid, r = proc(row)
-            key = r.key
-            logger.debug(f'key="{key}" cid={cid}')
-            try:
-                rtbl = tbl[cid]
-            except KeyError:
-                rtbl = {}
-                tbl[cid] = rtbl
-            try:
-                rl = rtbl[refty]
-            except KeyError:
-                rl = []
-                rtbl[refty] = rl
-            rd = r.to_dict()
-            if rd not in rl:
-                rl.append(rd)
-
-    logger.info(f'dumping into "{out_file}"...')
-    with open(out_file, 'w') as f:
-        json.dump(tbl, f)
+            cid = before_tbl.get(cid, cid)
+            if cids is not None and cid not in cids:
+                continue
+            add_ref(tbl, seen, refty, cid, r)
+
+    write_tbl(out_file, tbl, merge)
+
+    return nrows
+
+
+def dump_partitioned(driver, qtbl, query_tbl, out_file, method, pw, port,
+                     cids, merge, before_tbl, njobs):
+    groups = {}  # cid -> bindings of the version pairs for cid
+    for ver, ver_ in get_ver_pairs(driver, qtbl):
+        cid = get_cid(ver)
+        cid = before_tbl.get(cid, cid)
+        if cids is None or cid in cids:
+            groups.setdefault(cid, []).append({'ver': ver, 'ver_': ver_})
+    logger.info(f'{len(groups)} partitions')
+
+    local = threading.local()
+
+    def run(bindings):
+        d = get_local_driver(local, method, pw, port)
+        tbl = {}
+        seen = set()
+        n = 0
+        for ref, query in query_tbl.items():
+            refty = abbrev(ref)
+            proc = PROC_TBL[ref]
+            for binding in bindings:
+                for _, row in query_all(d, bind_vars(query, binding)):
+                    n += 1
+                    cid, r = proc(row)
+                    add_ref(tbl, seen, refty, before_tbl.get(cid, cid), r)
+        return tbl, n
+
+    nrows = 0
+    with MapWriter(out_file) as w:
+        for tbl, n in ordered_map(run, groups.values(), njobs=njobs):
+            nrows += n
+            for cid, rtbl in tbl.items():
+                w.write(cid, rtbl)
+        if merge:
+            w.write_old()
+
+    return nrows
+
+
+def add_dtor(tbl, seen, vnames, key, r, cids):
+    # seen: set of (cid, key, canonical dtor dict) already added
+    for cid in vnames:
+        if cids is not None and get_cid_of_ver_name(cid) not in cids:
+            continue
+        logger.debug(f'{cid} {key} {r}')
+        try:
+            ktbl = tbl[cid]
+        except KeyError:
+            ktbl = {}
+            tbl[cid] = ktbl
+        try:
+            rl = ktbl[key]
+        except KeyError:
+            rl = []
+            ktbl[key] = rl
+        k = (cid, key, get_canon(r))
+        if k not in seen:
+            seen.add(k)
+            rl.append(r)
 
 
 def dump_dtor_map(proj_id, out_file,
-                  method='odbc', pw=VIRTUOSO_PW, port=VIRTUOSO_PORT):
+                  method='odbc', pw=VIRTUOSO_PW, port=VIRTUOSO_PORT,
+                  cids=None, merge=False, ver_tbl=None, partitioned=None, njobs=1,
+                  index=False):
+    # ver_tbl: version name -> list of CID-before/CID-after names it stands for
+    # partitioned: run the query per version, njobs versions at a time,
+    # writing the map of each version as soon as it is found
+    # (None for doing so if the FB has AUTO_PARTITION_PAIRS pairs or more)
+    # index: also build the index of out_file (see dtor_index)
 
     driver = sparql.get_driver(method, pw=pw, port=port)
 
@@ -446,26 +737,63 @@ def dump_dtor_map(proj_id, out_file,
     qtbl = NS_TBL.copy()
     qtbl['graph_uri'] = graph_uri
 
+    query = DTOR_QUERY % qtbl
+
+    def get_vnames(ver):
+        vnames = [ver]
+        if ver_tbl:
+            vnames = ver_tbl.get(ver, vnames)
+        return vnames
+
+    if use_partitions(driver, qtbl, partitioned):
+        vers = set()
+        for pair in get_ver_pairs(driver, qtbl):
+            vers.update(pair)
+        vers = [v for v in sorted(vers)
+                if cids is None or
+                any(get_cid_of_ver_name(x) in cids for x in get_vnames(get_localname(v)))]
+        logger.info(f'{len(vers)} partitions')
+
+        local = threading.local()
+
+        def run(ver):
+            d = get_local_driver(local, method, pw, port)
+            tbl = {}
+            seen = set()
+            n = 0
+            for _, row in query_all(d, bind_vars(query, {'ver': ver})):
+                n += 1
+                v, key, r = proc_DTOR(row)
+                add_dtor(tbl, seen, get_vnames(v), key, r, cids)
+            return tbl, n
+
+        nrows = 0
+        with MapWriter(out_file) as w:
+            for tbl, n in ordered_map(run, vers, njobs=njobs):
+                nrows += n
+                for cid, ktbl in tbl.items():
+                    w.write(cid, ktbl)
+            if merge:
+                w.write_old()
+
+        if index:
+            dtor_index.build(out_file)
+
+        return nrows
+
     tbl = {}  # cid -> key -> (loc * offset * length) list
+    seen = set()
 
-    query = DTOR_QUERY % qtbl
+    nrows = 0
 
-    for _, row in driver.query(query):
-        cid, key, r = proc_DTOR(row)
-        logger.debug(f'{cid} {key} {r}')
-        try:
-            ktbl = tbl[cid]
-        except KeyError:
-            ktbl = {}
-            tbl[cid] = ktbl
-        try:
-            rl = ktbl[key]
-        except KeyError:
-            rl = []
-            ktbl[key] = rl
-        if r not in rl:
-            rl.append(r)
+    for _, row in query_all(driver, query):
+        nrows += 1
+        ver, key, r = proc_DTOR(row)
+        add_dtor(tbl, seen, get_vnames(ver), key, r, cids)
+
+    write_tbl(out_file, tbl, merge)
+
+    if index:
+        dtor_index.build(out_file)
 
-    logger.info(f'dumping into "{out_file}"...')
-    with open(out_file, 'w') as f:
-        json.dump(tbl, f)
+    return nrows
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+'''
+  resultcache.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import json
+import hashlib
+import logging
+
+from .misc import ensure_dir, read_json
+from .manifest import fingerprint
+
+logger = logging.getLogger()
+
+SRC_EXTS = ['.java']
+
+HASH_TBL_FILE_NAME = 'hashes.json'
+
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(1 << 20)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+def hash_dir(dpath, exts=SRC_EXTS, hash_tbl=None):
+    # content hash of the source files (relative path and blob hash of each)
+    # hash_tbl: path -> [size, mtime_ns, blob hash], reused while size and mtime are unchanged
+    entries = []
+    if os.path.isdir(dpath):
+        for root, dirs, files in os.walk(dpath):
+            dirs.sort()
+            for fn in sorted(files):
+                if any(fn.endswith(x) for x in exts):
+                    p = os.path.join(root, fn)
+                    if hash_tbl is None:
+                        h = hash_file(p)
+                    else:
+                        ap = os.path.abspath(p)
+                        st = os.stat(ap)
+                        e = hash_tbl.get(ap, None)
+                        if e is not None and e[:2] == [st.st_size, st.st_mtime_ns]:
+                            h = e[2]
+                        else:
+                            h = hash_file(p)
+                            hash_tbl[ap] = [st.st_size, st.st_mtime_ns, h]
+                    entries.append((os.path.relpath(p, dpath), h))
+    return fingerprint(entries)
+
+
+def extract_fragment(ref_tbl, dtor_tbl, cid):
+    frag = {
+        'ref_keys': ref_tbl.get(cid, {}),
+        'dtor_map': {
+            'before': dtor_tbl.get(f'{cid}-before', {}),
+            'after': dtor_tbl.get(f'{cid}-after', {}),
+        },
+    }
+    return frag
+
+
+def add_fragment(ref_tbl, dtor_tbl, cid, frag):
+    if frag['ref_keys']:
+        ref_tbl[cid] = frag['ref_keys']
+    for x in ('before', 'after'):
+        if frag['dtor_map'][x]:
+            dtor_tbl[f'{cid}-{x}'] = frag['dtor_map'][x]
+
+
+def read_tbl(path):
+    tbl = None
+    if os.path.exists(path):
+        tbl = read_json(path)
+    if tbl is None:
+        tbl = {}
+    return tbl
+
+
+def write_tbl(path, tbl):
+    ensure_dir(os.path.dirname(path))
+    logger.info(f'dumping into "{path}"...')
+    with open(path, 'w') as f:
+        json.dump(tbl, f)
+
+
+class ResultCache(object):
+    # results of version pairs (ref_keys/dtor_map fragments and diff stats)
+    # keyed by the content of both versions and the analysis configuration
+    # NB: change patterns (chgpat TTL) and FBs are not cached, so they cover only
+    # the version pairs analyzed in the run
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        ensure_dir(base_dir)
+        self._hash_path = os.path.join(base_dir, HASH_TBL_FILE_NAME)
+        self._hash_tbl = None
+
+    def hash_dir(self, dpath):
+        if self._hash_tbl is None:
+            self._hash_tbl = read_tbl(self._hash_path)
+        return hash_dir(dpath, hash_tbl=self._hash_tbl)
+
+    def save_hashes(self):
+        # drops the entries of the files removed since
+        if self._hash_tbl is None:
+            return
+        tbl = {p: e for p, e in self._hash_tbl.items() if os.path.exists(p)}
+        tmp = f'{self._hash_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(tbl, f)
+            os.replace(tmp, self._hash_path)
+        except Exception as e:
+            logger.warning(f'failed to write "{self._hash_path}": {e}')
+
+    def get_path(self, fp):
+        return os.path.join(self.base_dir, fp[:2], f'{fp}.json')
+
+    def get(self, fp):
+        path = self.get_path(fp)
+        d = None
+        if os.path.exists(path):
+            d = read_json(path)
+        return d
+
+    def put(self, fp, d):
+        path = self.get_path(fp)
+        ensure_dir(os.path.dirname(path))
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(d, f)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f'failed to write "{path}": {e}')
+
+    def export(self, ref_json, dtor_json, frag_tbl, merge=True):
+        # adds cached fragments (cid -> fragment) to the result files
+        # or replaces them with the fragments unless merge
+        if merge:
+            ref_tbl = read_tbl(ref_json)
+            dtor_tbl = read_tbl(dtor_json)
+        else:
+            ref_tbl = {}
+            dtor_tbl = {}
+        for cid, frag in frag_tbl.items():
+            add_fragment(ref_tbl, dtor_tbl, cid, frag)
+        write_tbl(ref_json, ref_tbl)
+        write_tbl(dtor_json, dtor_tbl)
+
+    def store(self, ref_json, dtor_json, entry_tbl):
+        # entry_tbl: cid -> (fingerprint, diff stats)
+        ref_tbl = read_tbl(ref_json)
+        dtor_tbl = read_tbl(dtor_json)
+        for cid, (fp, stat) in entry_tbl.items():
+            d = extract_fragment(ref_tbl, dtor_tbl, cid)
+            d['stat'] = stat
+            self.put(fp, d)
+        logger.info(f'stored {len(entry_tbl)} results into "{self.base_dir}"')
@@ -21,16 +21,30 @@
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import os
+import sys
 import csv
 import logging
+import time
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 
-from .common import VAR_DIR, FACT_DIR, LOG_DIR, FB_DIR
-from .common import VIRTUOSO_PW, VIRTUOSO_PORT
+from .common import VAR_DIR, FACT_DIR, LOG_DIR, FB_DIR, WORK_DIR, REFACT_DIR
+from .common import VIRTUOSO_PW, VIRTUOSO_PORT, parse_targets, get_proj_id
 from .misc import ensure_dir
+from .manifest import Manifest, MANIFEST_FILE_NAME, fingerprint
+from .profiler import Profiler, PROFILE_FILE_NAME, get_rusage, count_files
+from .diffcache import DiffCache, record_use
+from .supervisor import Supervisor
+from .resultcache import ResultCache
+from .ref_key_queries import QUERY_TBL, DTOR_QUERY
 from .setup_factbase import FB
 
 from . import misc
 from . import setup_factbase
+from . import gitsrc
+from . import virtuoso_ini
+from . import find_refactoring, materialize_supplementary_fact
+from . import dtor_index
 
 from cca.ccautil.cca_config import Config, VKIND_VARIANT
 from cca.ccautil.factextractor import Enc, HashAlgo
@@ -46,10 +60,35 @@ FACT_SIZE_THRESH = 100000
 FILE_SIM_THRESH = 0.5
 
 DIFF_CACHE_DIR = os.path.join(VAR_DIR, 'cache', 'diffast')
+DIFF_CACHE_SIZE = 32  # GB
+RESULT_CACHE_DIR = os.path.join(VAR_DIR, 'cache', 'rrj')
+
+# options of diff_dirs that every cache entry depends on
+DIFFAST_OPTS = {
+    'fact_for_changes': True,
+    'fact_for_mapping': True,
+    'fact_for_ast': True,
+    'fact_size_thresh': FACT_SIZE_THRESH,
+    'fact_for_cfg': False,
+    'fact_encoding': Enc.FDLCO,
+    'fact_hash_algo': HashAlgo.MD5,
+    'fact_no_compress': True,
+    'no_binding_trace': True,
+    'rrlv': 2,
+    'no_implicit_name_resolution': False,
+    'dump_delta': False,
+    'fact_for_delta': False,
+    'use_sim': True,
+    'sim_thresh': FILE_SIM_THRESH,
+    'no_node_count': True,
+}
 STAT_FILE = os.path.join(VAR_DIR, 'status')
 
 URL_BASE_PATH = '../../..'
 
+LOGGING_FORMAT = ('[%(asctime)s][%(processName)s]'
+                  '[%(levelname)s][%(module)s][%(funcName)s] %(message)s')
+
 #
 
 
@@ -63,23 +102,217 @@ def set_status(mes):
         logger.warning(str(e))
 
 
+def get_vpairs(cids):
+    return [(f'{cid}-before', f'{cid}-after') for cid in cids]
+
+
+def make_conf(proj_id, proj_dir, include, vpairs):
+    conf = Config()
+    conf.proj_id = proj_id
+    conf.lang = 'java'
+    conf.proj_path = proj_dir
+    conf.vkind = VKIND_VARIANT
+    conf.include = include
+    conf.vpairs = vpairs
+    conf.vers = []
+    for vpl in vpairs:
+        for v in vpl:
+            if v not in conf.vers:
+                conf.vers.append(v)
+    conf.get_long_name = lambda x: x
+    conf.finalize()
+    return conf
+
+
+def init_proc(log_level, log_dir):
+    pid = mp.current_process().name
+    log_file = os.path.join(log_dir, f'rrj.{pid}.log')
+    fh = logging.FileHandler(log_file, mode='w', encoding='utf-8')
+    fh.setLevel(log_level)
+    fmt = logging.Formatter(LOGGING_FORMAT)
+    fh.setFormatter(fmt)
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+    logger.addHandler(fh)
+    logger.setLevel(log_level)
+
+
+def get_pair_id(v_before, v_after):
+    pair_id = v_after  # a pair of consecutive commits in range mode
+    if v_before.endswith('-before') and v_after.endswith('-after'):
+        cid = v_before[:-len('-before')]
+        if cid == v_after[:-len('-after')]:
+            pair_id = cid
+        else:
+            pair_id = f'{v_before}-{v_after}'
+    return pair_id
+
+
+def get_ver_tbl(vpairs, cids):
+    # version name -> CID-before/CID-after names that it stands for
+    tbl = {}
+    for (v_before, v_after), cid in zip(vpairs, cids):
+        tbl.setdefault(v_before, []).append(f'{cid}-before')
+        tbl.setdefault(v_after, []).append(f'{cid}-after')
+    return tbl
+
+
+def compare(proj_dir, proj_id, v_before, v_after, fact_versions, fact_dir, opts):
+    t0 = time.monotonic()
+    ru0 = get_rusage()
+    dir_before = os.path.join(proj_dir, v_before)
+    dir_after = os.path.join(proj_dir, v_after)
+    r = diff_dirs(diffast, dir_before, dir_after,
+                  usecache=opts['usecache'],
+                  include=opts['include'],
+                  cache_dir_base=opts['cache_dir'],
+                  load_fact=True,
+                  fact_versions=fact_versions,
+                  fact_proj=proj_id,
+                  fact_proj_roots=[dir_before, dir_after],
+                  ignore_unmodified=opts['ignore_unmodified'],
+                  fact_into_directory=fact_dir,
+                  aggressive=opts['aggressive'],
+                  no_rename_rectification=opts['no_rename_rectification'],
+                  keep_going=opts['keep_going'],
+                  quiet=opts['quiet'],
+                  **DIFFAST_OPTS,
+                  )
+    result = {
+        'cost': r['cost'],
+        'nmappings': r['nmappings'],
+        'nrelabels': r['nrelabels'],
+    }
+    try:
+        result['nnodes1'] = r['nnodes1']
+        result['nnodes2'] = r['nnodes2']
+        result['nnodes'] = r['nnodes']
+    except KeyError:
+        logger.warning('failed to get total number of nodes')
+        nnodes1 = srcdiff.count_nodes([dir_before])
+        nnodes2 = srcdiff.count_nodes([dir_after])
+        result['nnodes1'] = nnodes1
+        result['nnodes2'] = nnodes2
+        result['nnodes'] = nnodes1 + nnodes2
+
+    # entries of the diff cache used for the pair are kept from eviction
+    nused = record_use(diffast, opts['cache_dir'], r['modified'])
+    logger.debug(f'{nused} diff cache entries used')
+
+    renamed_file_pairs = []
+    for f1, f2 in r['modified']:
+        _f1 = os.path.relpath(f1, dir_before)
+        _f2 = os.path.relpath(f2, dir_after)
+        if _f1 != _f2:
+            renamed_file_pairs.append((_f1, _f2))
+    result['renamed_file_pairs'] = renamed_file_pairs
+
+    ru1 = get_rusage()
+    result['profile'] = {
+        'wall': time.monotonic() - t0,
+        'cpu_self': ru1['cpu_self'] - ru0['cpu_self'],
+        'cpu_children': ru1['cpu_children'] - ru0['cpu_children'],
+        'maxrss_self_kb': ru1['maxrss_self_kb'],
+        'maxrss_children_kb': ru1['maxrss_children_kb'],
+    }
+
+    return result
+
+
+def compare_mp(tid_task):
+    tid, task = tid_task
+    result = compare(*task)
+    pid = mp.current_process().name
+    return (pid, tid, result)
+
+
+def compare_all(tid_tasks, jobs, log_level, log_dir):
+    ntasks = len(tid_tasks)
+    if jobs > 1 and ntasks > 1:
+        nprocs = min(jobs, ntasks)
+        set_status(f'comparing {ntasks} version pairs ({nprocs} processes)...')
+        count = 0
+        task_tbl = dict(tid_tasks)
+        with mp.Pool(processes=nprocs, initializer=init_proc,
+                     initargs=(log_level, log_dir)) as pool:
+            for pid, tid, result in pool.imap_unordered(compare_mp, tid_tasks,
+                                                        chunksize=1):
+                count += 1
+                v_before, v_after = task_tbl[tid][2:4]
+                set_status(f'[{pid}] compared "{v_before}" with "{v_after}"'
+                           f' ({count}/{ntasks})')
+                yield tid, result
+    else:
+        for tid, task in tid_tasks:
+            v_before, v_after = task[2:4]
+            set_status(f'comparing "{v_before}" with "{v_after}"...')
+            yield tid, compare(*task)
+
+
+def report_stat(proj_dir, v_before, v_after, result):
+    cost = result['cost']
+    nmappings = result['nmappings']
+    nrelabels = result['nrelabels']
+    nnodes1 = result['nnodes1']
+    nnodes2 = result['nnodes2']
+    nnodes = result['nnodes']
+    dist = 0
+    sim = 0
+    if nmappings > 0:
+        dist = float(cost) / float(nmappings)
+    if nnodes > 0:
+        sim = float(2 * (nmappings - nrelabels) + nrelabels) / float(nnodes)
+    logger.info(f'"{v_before}" -> "{v_after}"')
+    logger.info(f'nodes: {nnodes1} -> {nnodes2}')
+    logger.info(f'edit distance: {cost}')
+    logger.info(f'similarity: {sim}')
+    logger.info(f'evolutionary distance: {dist}')
+
+    renamed_file_pairs = result['renamed_file_pairs']
+    dir_before = os.path.join(proj_dir, v_before)
+    renamed_file_pairs_path = os.path.join(dir_before, 'renamed_file_pairs.csv')
+    if not os.path.exists(renamed_file_pairs_path) and renamed_file_pairs:
+        with open(renamed_file_pairs_path, 'w', newline='') as f:
+            w = csv.writer(f)
+            for row in renamed_file_pairs:
+                w.writerow(row)
+
+
+def get_analysis_fingerprint(include, analyze_unmodified, cache_opts, targets=None,
+                             localized=False, max_iter=None):
+    # partitioned queries and the number of jobs do not change the results
+    return fingerprint(include, analyze_unmodified, cache_opts,
+                       materialize_supplementary_fact.QUERIES,
+                       find_refactoring.QUERIES,
+                       QUERY_TBL, DTOR_QUERY, targets, localized, max_iter)
+
+
+def get_pair_fingerprint(result_cache, proj_dir, v_before, v_after, analysis_fp):
+    fp0 = result_cache.hash_dir(os.path.join(proj_dir, v_before))
+    fp1 = result_cache.hash_dir(os.path.join(proj_dir, v_after))
+    return fingerprint(fp0, fp1, analysis_fp)
+
+
 def shutdown_virtuoso(proj_id, port, pw=VIRTUOSO_PW):
-    if misc.is_virtuoso_running(port):
+    fb_dir = os.path.join(FB_DIR, proj_id)
+    sv = Supervisor(fb_dir, port=port, pw=pw)
+    rc = 0
+    if sv.is_running():
         logger.info(f'shutting down virtuoso for {proj_id}...')
-        fb_dir = os.path.join(FB_DIR, proj_id)
-        v = virtuoso.base(dbdir=fb_dir, pw=pw, port=port)
-        v.shutdown_server()
+        rc = sv.shutdown()
         logger.info('done.')
+    return rc
 
 
-def main():
+def create_argparser():
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
     parser = ArgumentParser(description='Reconstruct refactorings on Java programs',
                             formatter_class=ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument('proj_dir', type=str, help='project directory')
-    parser.add_argument('commit_id', metavar='CID', type=str, nargs='+',
+    parser.add_argument('proj_dir', type=str,
+                        help='project directory (git repository if --git is given)')
+    parser.add_argument('commit_id', metavar='CID', type=str, nargs='*',
                         help='commit id')
 
     parser.add_argument('--proj-id', type=str, metavar='PROJ_ID', default=None,
@@ -95,8 +328,15 @@ def main():
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='enable verbose printing')
 
-    parser.add_argument('--use-cache', dest='usecache', action='store_true',
-                        help='use cached diffast results')
+    parser.add_argument('--use-cache', dest='usecache', action='store_true', default=True,
+                        help='use cached diffast results (always on unless --no-cache)')
+
+    parser.add_argument('--no-cache', dest='usecache', action='store_false',
+                        help='recompute diffast results ignoring the cache')
+
+    parser.add_argument('--cache-size', dest='cache_size', metavar='GB', type=float,
+                        default=DIFF_CACHE_SIZE,
+                        help='evict least recently used diffast results beyond GB')
 
     parser.add_argument('--analyze-unmodified', dest='analyze_unmodified',
                         action='store_true',
@@ -112,6 +352,10 @@ def main():
                         action='store_false',
                         help='exits on failures')
 
+    parser.add_argument('--no-result-cache', dest='result_cache', action='store_false',
+                        help='analyze version pairs even if identical ones were analyzed before'
+                        ' (change patterns and FBs are produced only for the pairs analyzed)')
+
     parser.add_argument('--port', dest='port', default=VIRTUOSO_PORT,
                         metavar='PORT', type=int, help='set port number')
 
@@ -119,11 +363,94 @@ def main():
                         default=VIRTUOSO_PW,
                         help='set password to access FB')
 
-    parser.add_argument('-m', '--mem', dest='mem', metavar='GB', type=int,
-                        choices=[2, 4, 8, 16, 32, 48, 64], default=8,
-                        help='set available memory (GB)')
+    parser.add_argument('-m', '--mem', dest='mem', metavar='GB', type=virtuoso_ini.parse_mem,
+                        default=8,
+                        help='set available memory (GB: 2, 4, 8, 16, 32, 48 or 64)'
+                        ' or "auto" to size FB from cgroup limits')
 
-    args = parser.parse_args()
+    parser.add_argument('--fbs', dest='nfbs', metavar='N', type=int, default=1,
+                        help='number of FBs running concurrently on the host'
+                        ' (divides resources with --mem auto)')
+
+    parser.add_argument('--loaders', dest='nloaders', metavar='N', type=int, default=None,
+                        help='load facts with N bulk loader processes'
+                        ' (sized from cores and memory by default)')
+
+    parser.add_argument('--no-ont-template', dest='use_template', action='store_false',
+                        help='load ontologies into each new FB instead of cloning a template')
+
+    parser.add_argument('--max-iter', dest='max_iter', metavar='N', type=int,
+                        default=materialize_supplementary_fact.MAX_ITER,
+                        help='repeat iterative materialization queries at most N rounds')
+
+    parser.add_argument('--mat-jobs', dest='mat_jobs', metavar='N', type=int, default=1,
+                        help='run independent materialization queries over N connections')
+
+    parser.add_argument('--find-jobs', dest='find_jobs', metavar='N', type=int, default=1,
+                        help='run refactoring detection queries (and partitions of ref key'
+                        ' queries) over N connections'
+                        ' (0 for as many as the server threads of FB allow)')
+
+    parser.add_argument('--partitioned', dest='partitioned', action='store_true',
+                        help='run ref key and dtor queries per version pair'
+                        ' (done anyway for FBs of many version pairs)')
+
+    parser.add_argument('--dtor-index', dest='dtor_index', action='store_true',
+                        help='also build an index of the dtor map (dtor_map.db)'
+                        ' for candidate lookup')
+
+    parser.add_argument('--profile-queries', dest='profile_queries', action='store_true',
+                        help='record wall time, inserted triples and virtuoso profile'
+                        ' of each materialization query')
+
+    parser.add_argument('--targets', dest='targets', metavar='REF[:REF...]',
+                        type=parse_targets, default=None,
+                        help='find only the refactorings of the types (e.g. RV:RP) and'
+                        ' run only the queries they need')
+
+    parser.add_argument('--localized', dest='localized', action='store_true',
+                        help='materialize supplementary facts of entities only within'
+                        ' modified, added or removed type declarations')
+
+    parser.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int,
+                        default=1,
+                        help='compare version pairs in N parallel processes')
+
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                        help='start virtuoso and load facts while comparing version pairs')
+
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='skip stages recorded as done in the manifest of the project')
+
+    parser.add_argument('--git', dest='git', action='store_true',
+                        help='read commits from the git repository PROJ_DIR'
+                        ' instead of CID-before/CID-after directories')
+
+    parser.add_argument('--range', dest='rev_range', metavar='BASE..HEAD', default=None,
+                        help='analyze every commit of BASE..HEAD (along first parents)'
+                        ' in the git repository PROJ_DIR as pairs of consecutive'
+                        ' commits in one FB')
+
+    parser.add_argument('--scratch-dir', dest='scratch_dir', metavar='DIR', default=None,
+                        help='export changed files of the commits into DIR'
+                        ' (WORK_DIR/git/PROJ_ID by default)')
+
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='add new commits to an existing FB of the project')
+
+    parser.add_argument('--keep-virtuoso', dest='keep_virtuoso', action='store_true',
+                        help='do not shut down virtuoso when finished')
+
+    parser.add_argument('--status-file', dest='status_file', metavar='FILE',
+                        default=STAT_FILE,
+                        help='write current status into FILE')
+
+    return parser
+
+
+def run(args):
+    global STAT_FILE
+    STAT_FILE = args.status_file
 
     log_level = DEFAULT_LOGGING_LEVEL  # logging.WARNING
     if args.verbose:
@@ -131,8 +458,12 @@ def main():
     if args.debug:
         log_level = logging.DEBUG
 
+    proj_dir = args.proj_dir
+
+    git_mode = args.git or args.rev_range is not None
+
     if args.proj_id is None:
-        proj_id = os.path.basename(args.proj_dir)
+        proj_id = get_proj_id(proj_dir)
     else:
         proj_id = args.proj_id
 
@@ -161,108 +492,260 @@ def main():
 
     ###
 
+    # diffast results are shared across projects per set of options
+    diff_cache = DiffCache(DIFF_CACHE_DIR, max_gb=args.cache_size)
+    cache_opts = dict(DIFFAST_OPTS, aggressive=args.no_move_rectification,
+                      no_rename_rectification=args.no_rename_rectification)
+
+    diff_opts = {
+        'usecache': args.usecache,
+        'cache_dir': diff_cache.get_dir(cache_opts),
+        'include': args.include,
+        'ignore_unmodified': ignore_unmodified,
+        'aggressive': args.no_move_rectification,
+        'no_rename_rectification': args.no_rename_rectification,
+        'keep_going': keep_going,
+        'quiet': (log_level != logging.DEBUG),
+    }
+
+    if args.rev_range is not None and args.commit_id:
+        set_status('CIDs cannot be given with --range')
+        return 1
+
+    if args.rev_range is None and not args.commit_id:
+        set_status('no commits specified')
+        return 1
+
+    cids = args.commit_id
+    vpairs = get_vpairs(cids)
+    ver_tbl = None
+    pair_dirs = {}  # version pair -> directory containing both versions if not proj_dir
+
+    if git_mode:
+        # export changed files of the commits from the repository
+        repo_dir = proj_dir
+        proj_dir = args.scratch_dir or os.path.join(WORK_DIR, 'git', proj_id)
+        set_status(f'exporting commits from "{repo_dir}" into "{proj_dir}"...')
+        try:
+            if args.rev_range is None:
+                for cid in cids:
+                    gitsrc.materialize_commit(repo_dir, cid, proj_dir, include=args.include,
+                                              full=args.analyze_unmodified)
+            else:
+                # a commit names the same version in the pairs on both sides of it
+                commits = gitsrc.get_commits(repo_dir, args.rev_range)
+                if len(commits) < 2:
+                    set_status(f'no commits in {args.rev_range}')
+                    return 1
+                gitsrc.materialize_range(repo_dir, commits, proj_dir, include=args.include,
+                                         full=args.analyze_unmodified)
+                cids = commits[1:]
+                vpairs = list(zip(commits, commits[1:]))
+                for c0, c1 in vpairs:
+                    pair_dirs[(c0, c1)] = gitsrc.get_range_pair_dir(proj_dir, c0, c1)
+        except Exception as e:
+            set_status(f'failed to export commits: {e}')
+            return 1
+
+    # reuse results of version pairs identical to ones analyzed before
+    result_cache = None
+    cached = {}  # cid -> fragment
+    pair_fps = {}  # cid -> fingerprint
+    if args.result_cache:
+        set_status('looking up result cache...')
+        result_cache = ResultCache(RESULT_CACHE_DIR)
+        analysis_fp = get_analysis_fingerprint(args.include, args.analyze_unmodified,
+                                               cache_opts, targets=args.targets,
+                                               localized=args.localized,
+                                               max_iter=args.max_iter)
+        _vpairs = []
+        _cids = []
+        for (v_before, v_after), cid in zip(vpairs, cids):
+            pair_dir = pair_dirs.get((v_before, v_after), proj_dir)
+            fp = get_pair_fingerprint(result_cache, pair_dir, v_before, v_after, analysis_fp)
+            d = result_cache.get(fp)
+            if d is None:
+                pair_fps[cid] = fp
+                _vpairs.append((v_before, v_after))
+                _cids.append(cid)
+            else:
+                logger.info(f'{cid}: found in result cache ({fp})')
+                cached[cid] = d
+                report_stat(pair_dir, v_before, v_after, d['stat'])
+        result_cache.save_hashes()
+        vpairs = _vpairs
+        cids = _cids
+
+    if args.rev_range is not None:
+        ver_tbl = get_ver_tbl(vpairs, cids)
+
+    ref_json = os.path.join(REFACT_DIR, proj_id, 'ref_keys.json')
+    dtor_json = os.path.join(REFACT_DIR, proj_id, 'dtor_map.json')
+
+    if not vpairs:
+        set_status(f'all {len(cached)} version pairs found in result cache')
+        # results of earlier runs are kept only when adding to them
+        result_cache.export(ref_json, dtor_json, cached, merge=args.incremental)
+        if args.dtor_index:
+            dtor_index.ensure(dtor_json)
+        set_status('finished.')
+        return 0
+
     # setup config
-    conf = Config()
-    conf.proj_id = proj_id
-    conf.lang = 'java'
-    conf.proj_path = args.proj_dir
-    conf.vkind = VKIND_VARIANT
-    conf.include = args.include
-    conf.vpairs = [(f'{cid}-before', f'{cid}-after') for cid in args.commit_id]
-    conf.vers = [x for vpl in conf.vpairs for x in vpl]
-    conf.get_long_name = lambda x: x
-    conf.finalize()
+    conf = make_conf(proj_id, proj_dir, args.include, vpairs)
     logger.info('\n{}'.format(conf))
 
+    # diff dirs
+    fact_dir = os.path.join(FACT_DIR, proj_id)
+
+    tasks = []
     for v_before, v_after in conf.vpairs:
+        fact_versions = [conf.mkver_for_fact_by_name(v) for v in [v_before, v_after]]
+        pair_fact_dir = fact_dir
+        if args.pipeline or args.incremental:
+            pair_fact_dir = os.path.join(fact_dir, get_pair_id(v_before, v_after))
+        tasks.append((pair_dirs.get((v_before, v_after), proj_dir), proj_id,
+                      v_before, v_after, fact_versions, pair_fact_dir, diff_opts))
 
-        # diff dirs
-        ensure_dir(DIFF_CACHE_DIR)
-        set_status(f'comparing "{v_before}" with "{v_after}"...')
-        dir_before = os.path.join(args.proj_dir, v_before)
-        dir_after = os.path.join(args.proj_dir, v_after)
-        r = diff_dirs(diffast, dir_before, dir_after,
-                      usecache=args.usecache,
-                      include=args.include,
-                      cache_dir_base=DIFF_CACHE_DIR,
-                      load_fact=True,
-                      fact_versions=[conf.mkver_for_fact_by_name(v)
-                                     for v in [v_before, v_after]],
-                      fact_proj=proj_id,
-                      fact_proj_roots=[dir_before, dir_after],
-                      ignore_unmodified=ignore_unmodified,
-                      fact_for_changes=True,
-                      fact_for_mapping=True,
-                      fact_for_ast=True,
-                      fact_into_directory=os.path.join(FACT_DIR, proj_id),
-                      fact_size_thresh=FACT_SIZE_THRESH,
-                      fact_for_cfg=False,
-                      fact_encoding=Enc.FDLCO,
-                      fact_hash_algo=HashAlgo.MD5,
-                      fact_no_compress=True,
-                      aggressive=args.no_move_rectification,
-                      no_rename_rectification=args.no_rename_rectification,
-                      no_binding_trace=True,
-                      rrlv=2,
-                      no_implicit_name_resolution=False,
-                      dump_delta=False,
-                      fact_for_delta=False,
-                      keep_going=keep_going,
-                      use_sim=True,
-                      sim_thresh=FILE_SIM_THRESH,
-                      quiet=(log_level != logging.DEBUG),
-                      no_node_count=True,
-                      )
-        cost = r['cost']
-        nmappings = r['nmappings']
-        nrelabels = r['nrelabels']
-        try:
-            nnodes1 = r['nnodes1']
-            nnodes2 = r['nnodes2']
-            nnodes = r['nnodes']
-        except KeyError:
-            logger.warning('failed to get total number of nodes')
-            nnodes1 = srcdiff.count_nodes([dir_before])
-            nnodes2 = srcdiff.count_nodes([dir_after])
-            nnodes = nnodes1 + nnodes2
-        dist = 0
-        sim = 0
-        if nmappings > 0:
-            dist = float(cost) / float(nmappings)
-        if nnodes > 0:
-            sim = float(2 * (nmappings - nrelabels) + nrelabels) / float(nnodes)
-        logger.info(f'nodes: {nnodes1} -> {nnodes2}')
-        logger.info(f'edit distance: {cost}')
-        logger.info(f'similarity: {sim}')
-        logger.info(f'evolutionary distance: {dist}')
-
-        renamed_file_pairs = []
-        for f1, f2 in r['modified']:
-            _f1 = os.path.relpath(f1, dir_before)
-            _f2 = os.path.relpath(f2, dir_after)
-            if _f1 != _f2:
-                renamed_file_pairs.append((_f1, _f2))
-
-        renamed_file_pairs_path = os.path.join(dir_before, 'renamed_file_pairs.csv')
-        if not os.path.exists(renamed_file_pairs_path) and renamed_file_pairs:
-            with open(renamed_file_pairs_path, 'w', newline='') as f:
-                w = csv.writer(f)
-                for row in renamed_file_pairs:
-                    w.writerow(row)
+    manifest = Manifest(os.path.join(log_proj_dir, MANIFEST_FILE_NAME),
+                        resume=args.resume or args.incremental)
+
+    profiler = Profiler(os.path.join(log_proj_dir, PROFILE_FILE_NAME),
+                        proj_id=proj_id, port=args.port)
 
-    # setup FB
-    set_status('building factbase...')
     fb = FB(proj_id, mem=args.mem, pw=args.pw, port=args.port,
             build_only=False, conf=conf,
-            url_base_path=URL_BASE_PATH, logdir=log_proj_dir)
-    fb.setup()
+            url_base_path=URL_BASE_PATH, logdir=log_proj_dir,
+            manifest=manifest, profiler=profiler, ver_tbl=ver_tbl,
+            nloaders=args.nloaders, use_template=args.use_template, nfbs=args.nfbs,
+            max_iter=args.max_iter, mat_jobs=args.mat_jobs,
+            profile_queries=args.profile_queries, targets=args.targets,
+            localized=args.localized, find_jobs=args.find_jobs,
+            partitioned=args.partitioned or None, index_dtor_map=args.dtor_index)
+
+    results = {}
+    pending = []
+    fps = []
+    for tid, task in enumerate(tasks):
+        pair_dir, _, v_before, v_after, _, pair_fact_dir, _ = task
+        fp = fingerprint(pair_dir, v_before, v_after, pair_fact_dir,
+                         [(k, v) for k, v in diff_opts.items() if k != 'quiet'])
+        fps.append(fp)
+        stage = f'diff:{get_pair_id(v_before, v_after)}'
+        if manifest.is_done(stage, fp):
+            logger.info(f'skipping {stage} (already done)')
+            results[tid] = manifest.get_data(stage)
+        else:
+            pending.append((tid, task))
+
+    def set_compared(tid, result):
+        v_before, v_after = tasks[tid][2:4]
+        pair_id = get_pair_id(v_before, v_after)
+        manifest.set_done(f'diff:{pair_id}', fps[tid], data=result)
+        results[tid] = result
+        d = {'stage': f'diff:{pair_id}', 'nnodes': result['nnodes']}
+        d.update(result.get('profile', {}))
+        profiler.add(d)
+
+    update = args.incremental and fb.exists()
+
+    pipeline = args.pipeline and not update and (pending or not fb.is_loaded())
+
+    # entries of the diff cache are not evicted by other runs while comparing
+    with diff_cache.reading(), \
+         profiler.stage('diff', npairs=len(pending), jobs=args.jobs,
+                        pipeline=bool(pipeline)) as st:
+        if pipeline:
+            # virtuoso is set up and facts are loaded while comparing
+            with ThreadPoolExecutor(max_workers=1) as loader:
+                prepared = loader.submit(fb.prepare, mem=args.mem)
+
+                def load_fact(fact_dir):
+                    # nothing to load into when virtuoso failed to start
+                    rc = prepared.result()
+                    if rc != 0:
+                        return rc
+                    return fb.load_fact(fact_dir=fact_dir)
+
+                futures = [prepared]
+                for tid in sorted(results.keys()):
+                    pair_fact_dir = tasks[tid][5]
+                    futures.append(loader.submit(load_fact, pair_fact_dir))
+                for tid, result in compare_all(pending, args.jobs, log_level, log_proj_dir):
+                    set_compared(tid, result)
+                    pair_fact_dir = tasks[tid][5]
+                    futures.append(loader.submit(load_fact, pair_fact_dir))
+                set_status('waiting for facts to be loaded...')
+                rcs = [f.result() for f in futures]
+        else:
+            for tid, result in compare_all(pending, args.jobs, log_level, log_proj_dir):
+                set_compared(tid, result)
+        st['nfiles'], st['nbytes'] = count_files(fact_dir, ['.nt.gz'])
+
+    if pending:
+        with profiler.stage('diff_cache') as st:
+            try:
+                st['nentries'], st['nbytes'], st['nevicted'] = diff_cache.update()
+            except Exception as e:
+                logger.warning(f'failed to update diff cache: {e}')
+
+    for tid, task in enumerate(tasks):
+        pair_dir, _, v_before, v_after, _, _, _ = task
+        report_stat(pair_dir, v_before, v_after, results[tid])
 
-    if not args.debug:
+    # setup FB
+    set_status('building factbase...')
+    if update:
+        # pairs compared but not yet in the FB, e.g. because an earlier update failed
+        new_tids = manifest.get_undone([f'update:{cid}' for cid in cids], fps)
+        if new_tids:
+            new_cids = [cids[tid] for tid in new_tids]
+            new_conf = make_conf(proj_id, proj_dir, args.include,
+                                 [vpairs[tid] for tid in new_tids])
+            rc = fb.update([tasks[tid][5] for tid in new_tids], new_conf, new_cids)
+        else:
+            set_status('nothing to update')
+            rc = 0
+    elif pipeline:
+        if any(rc != 0 for rc in rcs):
+            set_status('failed to load facts')
+            rc = 1
+        else:
+            rc = fb.setup(preloaded=True)
+    else:
+        rc = fb.setup()
+
+    if rc == 0:
+        for tid, cid in enumerate(cids):
+            manifest.set_done(f'update:{cid}', fps[tid])
+
+    if result_cache is not None and rc == 0:
+        stats = {}
+        for tid, cid in enumerate(cids):
+            stats[cid] = (pair_fps[cid], results[tid])
+        result_cache.store(ref_json, dtor_json, stats)
+        if cached:
+            set_status(f'adding {len(cached)} version pairs from result cache...')
+            result_cache.export(ref_json, dtor_json, cached)
+            if args.dtor_index:
+                dtor_index.ensure(dtor_json)
+
+    if not args.debug and not args.keep_virtuoso:
         set_status(f'shutting down virtuoso (port={args.port})...')
         shutdown_virtuoso(proj_id, args.port, pw=args.pw)
 
     set_status('finished.')
 
+    return rc
+
+
+def main():
+    parser = create_argparser()
+    args = parser.parse_args()
+    rc = run(args)
+    if rc:
+        sys.exit(rc)
+
 
 if __name__ == '__main__':
     main()
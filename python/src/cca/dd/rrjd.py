@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+'''
+  rrjd.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import re
+import sys
+import json
+import signal
+import subprocess
+import threading
+import traceback
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .common import LOG_DIR, REFACT_DIR, VIRTUOSO_PW, VIRTUOSO_PORT, get_proj_id
+from .misc import ensure_dir, get_timestamp
+from .profiler import PROFILE_FILE_NAME
+from . import rrj
+
+from cca.ccautil.common import setup_logger, DEFAULT_LOGGING_LEVEL
+
+logger = logging.getLogger()
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_SERVICE_PORT = 8181
+
+JOB_PATH_PAT = re.compile(r'^/jobs/(?P<id>[0-9]+)(?P<sub>/[a-z_]+)?$')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+class Job(object):
+    def __init__(self, jid, spec):
+        self.id = jid
+        self.spec = spec
+        self.state = QUEUED
+        self.submitted = get_timestamp()
+        self.started = None
+        self.finished = None
+        self.rc = None
+        self.error = None
+        self.proj_id = None
+        self.port = None
+        self.status_file = get_status_file(jid)
+
+    def to_dict(self):
+        d = {
+            'id': self.id,
+            'state': self.state,
+            'spec': self.spec,
+            'proj_id': self.proj_id,
+            'port': self.port,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'rc': self.rc,
+            'error': self.error,
+        }
+        if self.state == RUNNING:
+            try:
+                with open(self.status_file) as f:
+                    d['status'] = f.read()
+            except Exception:
+                pass
+        if self.proj_id is not None:
+            d['results'] = get_result_paths(self.proj_id)
+        return d
+
+
+def get_status_file(jid):
+    return os.path.join(LOG_DIR, 'rrjd', 'status', str(jid))
+
+
+def get_result_paths(proj_id):
+    tbl = {
+        'ref_keys': os.path.join(REFACT_DIR, proj_id, 'ref_keys.json'),
+        'dtor_map': os.path.join(REFACT_DIR, proj_id, 'dtor_map.json'),
+        'profile': os.path.join(LOG_DIR, 'rrj', proj_id, PROFILE_FILE_NAME),
+    }
+    return tbl
+
+
+def make_argv(spec, extra_opts=[]):
+    # extra_opts are put after the options of spec to override them
+    argv = []
+    try:
+        proj_dir = spec['proj_dir']
+        cids = spec['commit_ids']
+    except KeyError as e:
+        raise ValueError(f'missing field: {e}')
+    if not isinstance(cids, list) or not cids:
+        raise ValueError('commit_ids must be a non-empty list')
+    proj_id = spec.get('proj_id', None)
+    if proj_id is not None:
+        argv += ['--proj-id', proj_id]
+    for d in spec.get('include', []):
+        argv += ['--include', d]
+    argv += [str(x) for x in spec.get('options', [])]
+    argv += extra_opts
+    argv += [proj_dir] + cids
+    return argv
+
+
+class Server(object):
+    # a virtuoso server kept running between jobs
+    def __init__(self, port):
+        self.port = port
+        self.proj_id = None
+        self.last_used = 0
+        self.busy = False
+
+
+class Service(object):
+    # runs a job per server at a time, each in an rrj process, so that up to
+    # len(ports) projects are analyzed concurrently. jobs of a project are run
+    # in submission order on the server holding its FB, if any.
+    def __init__(self, ports, pw=VIRTUOSO_PW):
+        self.pw = pw
+        self.servers = [Server(p) for p in ports]
+        self.jobs = {}
+        self._pending = []  # jobs not started yet in submission order
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._stopping = False
+        self._count = 0
+        self._tick = 0
+        self._workers = [threading.Thread(target=self.work, args=(s,),
+                                          name=f'rrjd-worker-{s.port}', daemon=True)
+                         for s in self.servers]
+
+    def start(self):
+        for w in self._workers:
+            w.start()
+
+    def submit(self, spec):
+        args = rrj.create_argparser().parse_args(make_argv(spec))
+        proj_id = args.proj_id
+        if proj_id is None:
+            proj_id = get_proj_id(args.proj_dir)
+        with self._cond:
+            self._count += 1
+            job = Job(self._count, spec)
+            job.proj_id = proj_id
+            self.jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify_all()
+        logger.info(f'job {job.id} submitted')
+        return job
+
+    def get_job(self, jid):
+        with self._lock:
+            return self.jobs.get(jid, None)
+
+    def list_jobs(self):
+        with self._lock:
+            return [j.to_dict() for j in self.jobs.values()]
+
+    def take_job(self, server):
+        # the first pending job server may run (called with the lock held)
+        busy = set(s.proj_id for s in self.servers if s.busy)
+        held = dict((s.proj_id, s) for s in self.servers if s.proj_id is not None)
+        lru = min((s for s in self.servers if not s.busy), key=lambda x: x.last_used)
+        for job in self._pending:
+            if job.proj_id in busy:
+                continue
+            owner = held.get(job.proj_id, None)
+            if owner is server or (owner is None and lru is server):
+                self._pending.remove(job)
+                return job
+        return None
+
+    def make_cmd(self, job, server):
+        extra_opts = ['--proj-id', job.proj_id,
+                      '--port', str(server.port),
+                      '--pw', self.pw,
+                      '--status-file', job.status_file,
+                      '--keep-virtuoso',
+                      # new commits are added to the FB left by earlier jobs
+                      '--incremental']
+        return ([sys.executable, '-m', 'cca.dd.rrj', '--fbs', str(len(self.servers))] +
+                make_argv(job.spec, extra_opts))
+
+    def run_job(self, job, server, released=None):
+        # released: project whose virtuoso server is shut down first
+        if released is not None:
+            logger.info(f'releasing port {server.port} from "{released}"...')
+            rrj.shutdown_virtuoso(released, server.port, pw=self.pw)
+        ensure_dir(os.path.dirname(job.status_file))
+        cmd = self.make_cmd(job, server)
+        logger.info(f'[job {job.id}] {" ".join(cmd)}')
+        p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            err = p.stderr.decode('utf-8', errors='replace').strip()
+            job.error = err.splitlines()[-1] if err else None
+        return p.returncode
+
+    def work(self, server):
+        while True:
+            with self._cond:
+                job = None
+                while not self._stopping:
+                    job = self.take_job(server)
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                if job is None:
+                    break
+                released = None
+                if server.proj_id != job.proj_id:
+                    released = server.proj_id
+                    server.proj_id = job.proj_id
+                server.busy = True
+                self._tick += 1
+                server.last_used = self._tick
+                job.port = server.port
+                job.state = RUNNING
+                job.started = get_timestamp()
+            logger.info(f'job {job.id} started on port {server.port}')
+            try:
+                job.rc = self.run_job(job, server, released=released)
+                job.state = FINISHED if job.rc == 0 else FAILED
+            except BaseException as e:
+                job.error = str(e)
+                job.state = FAILED
+                logger.error(traceback.format_exc())
+            job.finished = get_timestamp()
+            logger.info(f'job {job.id} {job.state}')
+            with self._cond:
+                server.busy = False
+                self._cond.notify_all()
+
+    def shutdown(self):
+        # waits for the running jobs, leaving the pending ones
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for w in self._workers:
+            w.join()
+        for s in self.servers:
+            if s.proj_id is not None:
+                rrj.shutdown_virtuoso(s.proj_id, s.port, pw=self.pw)
+                s.proj_id = None
+
+
+def make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, fmt, *args):
+            logger.info(fmt % args)
+
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_file(self, path):
+            if not os.path.exists(path):
+                self.send_json(404, {'error': f'not found: {path}'})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                while True:
+                    b = f.read(1 << 20)
+                    if not b:
+                        break
+                    self.wfile.write(b)
+
+        def do_GET(self):
+            if self.path == '/jobs':
+                self.send_json(200, service.list_jobs())
+                return
+            m = JOB_PATH_PAT.match(self.path)
+            if m is None:
+                self.send_json(404, {'error': f'unknown path: {self.path}'})
+                return
+            job = service.get_job(int(m.group('id')))
+            if job is None:
+                self.send_json(404, {'error': 'no such job'})
+                return
+            sub = m.group('sub')
+            if sub is None:
+                self.send_json(200, job.to_dict())
+            elif job.proj_id is not None and sub[1:] in get_result_paths(job.proj_id):
+                self.send_file(get_result_paths(job.proj_id)[sub[1:]])
+            else:
+                self.send_json(404, {'error': f'unknown path: {self.path}'})
+
+        def do_POST(self):
+            if self.path == '/shutdown':
+                self.send_json(200, {})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            if self.path != '/jobs':
+                self.send_json(404, {'error': f'unknown path: {self.path}'})
+                return
+            try:
+                n = int(self.headers.get('Content-Length', 0))
+                spec = json.loads(self.rfile.read(n))
+                job = service.submit(spec)
+            except (ValueError, SystemExit) as e:
+                self.send_json(400, {'error': f'invalid job: {e}'})
+                return
+            self.send_json(202, job.to_dict())
+
+    return Handler
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(description='Serve rrj jobs with warm virtuoso servers',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--host', dest='host', default=DEFAULT_HOST,
+                        help='address to listen on')
+
+    parser.add_argument('--service-port', dest='service_port', type=int,
+                        default=DEFAULT_SERVICE_PORT, metavar='PORT',
+                        help='HTTP port to listen on')
+
+    parser.add_argument('--port', dest='port', default=VIRTUOSO_PORT,
+                        metavar='PORT', type=int, help='set (first) port number for virtuoso')
+
+    parser.add_argument('-n', '--nservers', dest='nservers', type=int, default=1,
+                        metavar='N', help='run up to N jobs concurrently, keeping'
+                        ' a virtuoso server warm for each')
+
+    parser.add_argument('--pw', dest='pw', metavar='PASSWORD',
+                        default=VIRTUOSO_PW,
+                        help='set password to access FB')
+
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true',
+                        help='enable debug printing')
+
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='enable verbose printing')
+
+    args = parser.parse_args()
+
+    log_level = DEFAULT_LOGGING_LEVEL  # logging.WARNING
+    if args.verbose:
+        log_level = logging.INFO
+    if args.debug:
+        log_level = logging.DEBUG
+
+    log_dir = os.path.join(LOG_DIR, 'rrjd')
+    ensure_dir(log_dir)
+    setup_logger(logger, log_level, log_file=os.path.join(log_dir, 'rrjd.log'))
+
+    ports = [args.port + i for i in range(args.nservers)]
+
+    service = Service(ports, pw=args.pw)
+    service.start()
+
+    httpd = ThreadingHTTPServer((args.host, args.service_port), make_handler(service))
+
+    def handle_term(signum, frame):
+        threading.Thread(target=httpd.shutdown).start()
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+    logger.info(f'listening on {args.host}:{args.service_port} (virtuoso ports: {ports})')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        logger.info('shutting down...')
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -34,7 +34,7 @@ from .ref import Ref
 from .common import LOG_DIR, REFACT_DIR, WORK_DIR
 from .misc import ensure_dir
 from .scan_oracle import scan_oracle
-from . import misc
+from . import misc, dtor_index
 from .siteconf import MERGE_SCENARIO_ROOT
 from cca.ccautil.proc import system
 from cca.ccautil.sloccount import sloccount_for_lang
@@ -437,39 +437,39 @@ class Executor(object):
 
                 logger.info(f'vt={vt} v={v} vt_={vt_} v_={v_} meth_={meth_} cfqn_={cfqn_}')
 
-                logger.info(f'loading "{dtor_map_path}"...')
-                with open(dtor_map_path) as f:
-                    dtor_map = json.load(f)
-                    dl = []
-                    dl_ = []
-                    for x in dtor_map.get(cid, {}).get(vt, []):
-                        d = {
-                            'offset': x['offset'],
-                            'length': x['length'],
-                            'name': v_,
-                            'loc': x['loc'],
+                # built once (or when dtor_map.json is updated) instead of loading
+                # the whole map for every key
+                index_path = dtor_index.ensure(dtor_map_path)
+
+                dl = []
+                dl_ = []
+                for x in dtor_index.lookup(index_path, cid, vt):
+                    d = {
+                        'offset': x['offset'],
+                        'length': x['length'],
+                        'name': v_,
+                        'loc': x['loc'],
+                    }
+                    dl.append(d)
+
+                for x_ in dtor_index.lookup(index_path, cid_, vt_, meth=meth_, cls=cfqn_):
+                    logger.info(f'x_={x_}')
+                    d_ = {
+                        'offset': x_['offset'],
+                        'length': x_['length'],
+                        'name': v,
+                        'loc': x_['loc'],
+                    }
+                    dl_.append(d_)
+
+                for d_ in dl_:
+                    for d in dl:
+                        r = {
+                            'key': key,
+                            'desc': d,
+                            'desc_': d_,
                         }
-                        dl.append(d)
-
-                    for x_ in dtor_map.get(cid_, {}).get(vt_, []):
-                        if x_['meth'] == meth_ and x_['class'] == cfqn_:
-                            logger.info(f'x_={x_}')
-                            d_ = {
-                                'offset': x_['offset'],
-                                'length': x_['length'],
-                                'name': v,
-                                'loc': x_['loc'],
-                            }
-                            dl_.append(d_)
-
-                    for d_ in dl_:
-                        for d in dl:
-                            r = {
-                                'key': key,
-                                'desc': d,
-                                'desc_': d_,
-                            }
-                            candl.append(r)
+                        candl.append(r)
         return candl
 
     def execute_oracle_refs(self, oracle_path, scenarios_path, target_refs=TARGET_REF_LIST):
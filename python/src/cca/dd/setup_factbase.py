@@ -21,15 +21,24 @@
 __author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
 
 import os
-import time
+import json
+import fcntl
 import logging
 
 from .common import ONT_DIR, FB_DIR, WORK_DIR, FACT_DIR, REFACT_DIR
 from .common import VIRTUOSO_PW, VIRTUOSO_PORT
-from .misc import is_virtuoso_running, gen_password, rm, ensure_dir, clear_dirs
+from .misc import gen_password, rm, ensure_dir, clear_dirs, clear_dir, clone_file
+from .misc import read_json
+from .misc import get_custom_timestamp
 
 from . import misc, find_refactoring, ref_keys
 from . import virtuoso_ini
+from .manifest import fingerprint, fingerprint_files
+from .profiler import NullProfiler, count_files
+from .supervisor import Supervisor, DBA_PW
+from .qprofile import QueryProfiler
+from .querydeps import get_reads
+from .ref_key_queries import DTOR_QUERY
 
 from cca.ccautil import virtuoso, load_into_virtuoso, load_ont_into_virtuoso
 # from cca.ccautil import materialize_supplementary_fact
@@ -46,8 +55,18 @@ TEMP_DIRS = [
     FACT_DIR,
 ]
 
+# a DB with the ontologies loaded, cloned into every new FB
+TEMPLATE_DIR = os.path.join(FB_DIR, '.template')
+TEMPLATE_INFO_FILE = 'template.json'
+
 FB_FILES = ['virtuoso'+x for x in ['-temp.db', '.db', '.log', '.pxa', '.trx', '.ini']]
 
+LOAD_STAGES = ['load_fact', 'load_ont']
+LOAD_ERR_MARK = 'LOAD_ERROR:'
+LOAD_ERR_SEP = ' :: '
+
+POST_LOAD_STAGES = ['materialize', 'find_refactoring', 'load_chgpat', 'ref_keys', 'dtor_map']
+
 ###
 
 
@@ -68,9 +87,10 @@ def create_argparser(desc):
     parser.add_argument('--pw', dest='pw', metavar='PASSWORD', default=VIRTUOSO_PW,
                         help='set password to access FB')
 
-    parser.add_argument('-m', '--mem', dest='mem', metavar='GB', type=int,
-                        choices=[2, 4, 8, 16, 32, 48, 64], default=8,
-                        help='set available memory (GB)')
+    parser.add_argument('-m', '--mem', dest='mem', metavar='GB', type=virtuoso_ini.parse_mem,
+                        default=8,
+                        help='set available memory (GB: 2, 4, 8, 16, 32, 48 or 64)'
+                        ' or "auto" to size FB from cgroup limits')
 
     parser.add_argument('--build-only', dest='build_only', action='store_true',
                         help='stop after FB is built')
@@ -82,12 +102,53 @@ def set_status(mes):
     logger.info(mes)
 
 
+def get_nloaders(mem, nfbs=1):
+    # number of bulk loader processes for the cores and memory (GB) of an FB
+    ncpus = max(1, virtuoso_ini.get_cpu_limit() // max(1, nfbs))
+    mem = virtuoso_ini.get_mem_gb(mem, nfbs)
+    n = max(1, min(int(ncpus / 2.5), mem // 2))
+    return n
+
+
+def get_target_reads(targets):
+    # names read by the detection and ref key queries for targets (None for "any")
+    texts = [find_refactoring.read_query(q[0])
+             for q in find_refactoring.get_target_queries(targets)['java']]
+    texts += list(ref_keys.get_query_tbl(targets).values())
+    texts.append(DTOR_QUERY)
+    reads = set()
+    for text in texts:
+        r = get_reads(text)
+        if r is None:
+            return None
+        reads |= r
+    return reads
+
+
 class FB(object):
     def __init__(self, proj_id, mem=4, pw=VIRTUOSO_PW, port=VIRTUOSO_PORT,
                  build_only=False, conf=None,
-                 set_status=set_status, url_base_path='..', logdir=os.curdir):
+                 set_status=set_status, url_base_path='..', logdir=os.curdir,
+                 manifest=None, profiler=None, ver_tbl=None, nloaders=None,
+                 use_template=True, nfbs=1,
+                 max_iter=materialize_supplementary_fact.MAX_ITER, mat_jobs=1,
+                 profile_queries=False, targets=None, localized=False, find_jobs=1,
+                 partitioned=None, index_dtor_map=False):
         self._proj_id = proj_id
         self._mem = mem
+        self._nfbs = nfbs  # FBs running concurrently on the host
+        self._ini_params = None
+        self._max_iter = max_iter
+        self._mat_jobs = mat_jobs
+        self._targets = targets  # refactoring types to find (None for all)
+        self._target_reads = None
+        if targets is not None:
+            self._target_reads = get_target_reads(targets)
+            logger.info(f'targets: {", ".join(targets)}')
+        self._localized = localized  # materialize only within modified type declarations
+        self._find_jobs = find_jobs  # 0 for as many as the server can run
+        self._partitioned = partitioned  # run ref key queries per version pair (None: if large)
+        self._index_dtor_map = index_dtor_map  # build dtor_map.db along with dtor_map.json
         self._port = port
 
         if pw is None:
@@ -98,6 +159,7 @@ class FB(object):
         logger.info(f'pw={self._pw} port={self._port}')
 
         self._fb_dir = os.path.join(FB_DIR, self._proj_id)
+        self._supervisor = Supervisor(self._fb_dir, port=self._port, pw=self._pw)
         self._fact_dir = os.path.join(FACT_DIR, self._proj_id)
         self._chgpat_dir = os.path.join(self._fact_dir, 'chgpat')
         self._build_only = build_only
@@ -107,25 +169,117 @@ class FB(object):
 
         self.logdir = logdir
 
+        self._qprof = None
+        if profile_queries:
+            self._qprof = QueryProfiler(logdir, supervisor=self._supervisor)
+
+        self._manifest = manifest
+
+        self._ver_tbl = ver_tbl
+
+        if nloaders is None:
+            nloaders = get_nloaders(mem, nfbs=nfbs)
+        self._nloaders = nloaders
+        logger.info(f'{nloaders} loaders')
+
+        self._use_template = use_template
+        self._ont_loaded = False
+
+        if profiler is None:
+            self._profiler = NullProfiler()
+        else:
+            self._profiler = profiler
+
     def init_virtuoso(self, mem=4):
+        with self._profiler.stage('init_virtuoso', mem=mem) as st:
+            stat = self._init_virtuoso(mem=mem)
+            st['rc'] = stat
+            st['ini'] = self._ini_params
+        return stat
+
+    def _init_virtuoso(self, mem=4):
         stat = 0
-        if is_virtuoso_running(self._port):
+        if self._supervisor.is_running():
             logger.warning('virtuoso is already running')
             stat = 1
         else:
             if ensure_dir(self._fb_dir):
+                if self._use_template:
+                    # no transaction log of an old DB may be replayed onto the clone
+                    self.clear_fb()
+                    if self.clone_template(mem=mem) == 0:
+                        self._ont_loaded = True
+                    else:
+                        logger.warning('failed to clone template, loading ontologies...')
+                        rm(os.path.join(self._fb_dir, 'virtuoso.db'))
+
                 fname = os.path.join(self._fb_dir, 'virtuoso.ini')
-                virtuoso_ini.gen_ini(self._fb_dir, self._fact_dir, ONT_DIR, fname,
-                                     mem=mem, port=self._port)
+                self._ini_params = virtuoso_ini.gen_ini(self._fb_dir, self._fact_dir,
+                                                        ONT_DIR, fname, mem=mem,
+                                                        port=self._port, nfbs=self._nfbs)
 
-                v = virtuoso.base(dbdir=self._fb_dir, port=self._port)
-                rc = v.start_server()
+                rc = self._supervisor.start(pw=DBA_PW)
                 if rc == 0:
+                    v = virtuoso.base(dbdir=self._fb_dir, port=self._port)
                     rc = v.set_password(self._pw)
                 if rc != 0:
                     stat = 1
         return stat
 
+    def get_template_info(self):
+        return {'ont': self.get_ont_fingerprint()}
+
+    def is_template_valid(self):
+        info_file = os.path.join(TEMPLATE_DIR, TEMPLATE_INFO_FILE)
+        return (os.path.exists(info_file) and
+                read_json(info_file) == self.get_template_info() and
+                os.path.exists(os.path.join(TEMPLATE_DIR, 'virtuoso.db')))
+
+    def build_template(self, mem=4):
+        self.set_status('building ontology template...')
+        clear_dir(TEMPLATE_DIR, exclude=['lock'])
+        fname = os.path.join(TEMPLATE_DIR, 'virtuoso.ini')
+        virtuoso_ini.gen_ini(TEMPLATE_DIR, self._fact_dir, ONT_DIR, fname,
+                             mem=mem, port=self._port, nfbs=self._nfbs)
+        sv = Supervisor(TEMPLATE_DIR, port=self._port, pw=DBA_PW)
+        rc = sv.start(pw=DBA_PW)
+        if rc == 0:
+            rc = load_ont_into_virtuoso.load(TEMPLATE_DIR,
+                                             ONT_DIR,
+                                             nprocs=self._nloaders,
+                                             pw=DBA_PW,
+                                             port=self._port,
+                                             logdir=self.logdir)
+            # shutdown makes a checkpoint so that virtuoso.db is self-contained
+            if sv.shutdown() != 0:
+                rc = 1
+        if rc == 0:
+            with open(os.path.join(TEMPLATE_DIR, TEMPLATE_INFO_FILE), 'w') as f:
+                json.dump(self.get_template_info(), f)
+        return rc
+
+    def clone_template(self, mem=4):
+        with self._profiler.stage('clone_template') as st:
+            if not ensure_dir(TEMPLATE_DIR):
+                return 1
+            with open(os.path.join(TEMPLATE_DIR, 'lock'), 'w') as lockf:
+                fcntl.flock(lockf, fcntl.LOCK_EX)
+                try:
+                    st['built'] = False
+                    if not self.is_template_valid():
+                        rc = self.build_template(mem=mem)
+                        if rc != 0:
+                            return rc
+                        st['built'] = True
+                    # the template is copied, never linked, as virtuoso writes into the DB
+                    logger.info(f'{self._fb_dir} <- {TEMPLATE_DIR}')
+                    rc = clone_file(os.path.join(TEMPLATE_DIR, 'virtuoso.db'),
+                                    os.path.join(self._fb_dir, 'virtuoso.db'))
+                finally:
+                    fcntl.flock(lockf, fcntl.LOCK_UN)
+            st['rc'] = rc
+        return rc
+
     def get_fb_files(self):
         return [os.path.join(self._fb_dir, x) for x in FB_FILES]
 
@@ -142,89 +296,161 @@ class FB(object):
     def start_virtuoso(self):
         logger.info('starting virtuoso...')
         stat = 0
-        if is_virtuoso_running(self._port):
-            logger.warning('virtuoso is already running')
+        if self._supervisor.start() != 0:
             stat = 1
-        else:
-            v = virtuoso.base(dbdir=self._fb_dir, port=self._port)
-            rc = v.start_server()
-            if rc != 0:
-                stat = 1
-        return stat
         logger.info('done.')
+        return stat
 
     def shutdown_virtuoso(self):
         logger.info('shutting down virtuoso...')
-        stat = 0
-        if is_virtuoso_running(self._port):
-            v = virtuoso.base(dbdir=self._fb_dir, port=self._port, pw=self._pw)
-            rc = v.shutdown_server()
-            if rc != 0 or is_virtuoso_running(self._port):
-                stat = 1
+        stat = self._supervisor.shutdown()
         logger.info('done.')
         return stat
 
     def restart_virtuoso(self):
         logger.info('restarting virtuoso...')
-        time.sleep(6)
-        self.shutdown_virtuoso()
-        time.sleep(10)
-        self.start_virtuoso()
-        time.sleep(6)
+        stat = self._supervisor.restart()
         logger.info('done.')
+        return stat
+
+    def ensure_virtuoso(self):
+        # restarts virtuoso if it has crashed or stopped responding
+        return self._supervisor.ensure()
 
     def reset_virtuoso(self):
-        stat = 0
-        if is_virtuoso_running(self._port):
-            v = virtuoso.base(dbdir=self._fb_dir, pw=self._pw, port=self._port)
-            rc = v.shutdown_server()
-            if rc != 0 or is_virtuoso_running(self._port):
-                stat = 1
-            else:
-                stat = self.clear_fb()
-        else:
+        stat = self._supervisor.shutdown()
+        if stat == 0:
             stat = self.clear_fb()
         return stat
 
-    def load_fact(self):
-        rc = load_into_virtuoso.load(self._proj_id,
-                                     self._fb_dir,
-                                     self._fact_dir,
-                                     ['.nt.gz'],
-                                     nprocs=1,
-                                     maxfiles=500,
-                                     pw=self._pw,
-                                     port=self._port,
-                                     logdir=self.logdir)
+    def load_fact(self, fact_dir=None):
+        if fact_dir is None:
+            fact_dir = self._fact_dir
+        nfiles, nbytes = count_files(fact_dir, ['.nt.gz'])
+        with self._profiler.stage('load_fact', fact_dir=fact_dir, nloaders=self._nloaders,
+                                  nfiles=nfiles, nbytes=nbytes) as st:
+            rc = load_into_virtuoso.load(self._proj_id,
+                                         self._fb_dir,
+                                         fact_dir,
+                                         ['.nt.gz'],
+                                         nprocs=self._nloaders,
+                                         maxfiles=500,
+                                         pw=self._pw,
+                                         port=self._port,
+                                         logdir=self.logdir)
+            st['rc'] = rc
+            st['nerrors'] = self.report_load_errors(fact_dir)
         return rc
 
-    def load_chgpat(self):
-        rc = load_into_virtuoso.load(self._proj_id,
-                                     self._fb_dir,
-                                     self._chgpat_dir,
-                                     ['.ttl'],
-                                     nprocs=1,
-                                     pw=self._pw,
-                                     port=self._port,
-                                     logdir=self.logdir)
+    def load_chgpat(self, chgpat_dir=None):
+        if chgpat_dir is None:
+            chgpat_dir = self._chgpat_dir
+        nfiles, nbytes = count_files(chgpat_dir, ['.ttl'])
+        with self._profiler.stage('load_chgpat', nloaders=self._nloaders,
+                                  nfiles=nfiles, nbytes=nbytes) as st:
+            rc = load_into_virtuoso.load(self._proj_id,
+                                         self._fb_dir,
+                                         chgpat_dir,
+                                         ['.ttl'],
+                                         nprocs=self._nloaders,
+                                         pw=self._pw,
+                                         port=self._port,
+                                         logdir=self.logdir)
+            st['rc'] = rc
+            st['nerrors'] = self.report_load_errors(chgpat_dir)
         return rc
 
     def load_ont(self):
         logger.info(f'{self._fb_dir} <- {ONT_DIR}')
-        return load_ont_into_virtuoso.load(self._fb_dir,
-                                           ONT_DIR,
-                                           nprocs=1,
-                                           pw=self._pw,
-                                           port=self._port,
-                                           logdir=self.logdir)
-
-    def materialize(self):
-        return materialize_supplementary_fact.materialize(self._proj_id,
-                                                          pw=self._pw,
-                                                          port=self._port,
-                                                          conf=self._conf)
-
-    def build_fb(self, mem=4):
+        with self._profiler.stage('load_ont', nloaders=self._nloaders) as st:
+            rc = load_ont_into_virtuoso.load(self._fb_dir,
+                                             ONT_DIR,
+                                             nprocs=self._nloaders,
+                                             pw=self._pw,
+                                             port=self._port,
+                                             logdir=self.logdir)
+            st['rc'] = rc
+            st['nerrors'] = self.report_load_errors(ONT_DIR)
+        return rc
+
+    def get_load_errors(self, dpath):
+        # files under dpath that the bulk loader failed to load: (path, error) list
+        d = os.path.abspath(dpath).replace("'", "''")
+        sql = (f"SELECT concat('{LOAD_ERR_MARK}', ll_file, '{LOAD_ERR_SEP}', ll_error)"
+               f" FROM DB.DBA.LOAD_LIST"
+               f" WHERE ll_error IS NOT NULL AND ll_file LIKE '{d}/%';")
+        out = self._supervisor.exec_sql(sql)
+        errs = []
+        if out is not None:
+            for line in out.splitlines():
+                line = line.strip()
+                if line.startswith(LOAD_ERR_MARK):
+                    path, _, err = line[len(LOAD_ERR_MARK):].partition(LOAD_ERR_SEP)
+                    errs.append((path, err))
+        return errs
+
+    def report_load_errors(self, dpath):
+        # failed files are reported and skipped, the rest of the batch stays loaded
+        errs = self.get_load_errors(dpath)
+        for path, err in errs:
+            logger.warning(f'failed to load "{path}": {err}')
+        if errs:
+            self.set_status(f'failed to load {len(errs)} files in "{dpath}"')
+        return len(errs)
+
+    def materialize(self, conf=None):
+        if conf is None:
+            conf = self._conf
+        with self._profiler.stage('materialize', max_iter=self._max_iter,
+                                  njobs=self._mat_jobs) as st:
+            st['rounds'] = []
+            rc = materialize_supplementary_fact.materialize(self._proj_id,
+                                                            pw=self._pw,
+                                                            port=self._port,
+                                                            conf=conf,
+                                                            max_iter=self._max_iter,
+                                                            rounds=st['rounds'],
+                                                            njobs=self._mat_jobs,
+                                                            qprof=self._qprof,
+                                                            reads=self._target_reads,
+                                                            localized=self._localized,
+                                                            scope=st)
+            st['rc'] = rc
+        return rc
+
+    def get_fact_fingerprint(self):
+        return fingerprint_files(self._fact_dir, ['.nt.gz'])
+
+    def get_ont_fingerprint(self):
+        return fingerprint_files(ONT_DIR)
+
+    def is_done(self, stage, fp):
+        return self._manifest is not None and self._manifest.is_done(stage, fp)
+
+    def set_done(self, stage, fp):
+        if self._manifest is not None:
+            self._manifest.set_done(stage, fp)
+
+    def is_loaded(self):
+        return (self.is_done('load_fact', self.get_fact_fingerprint()) and
+                self.is_done('load_ont', self.get_ont_fingerprint()) and
+                os.path.exists(os.path.join(self._fb_dir, 'virtuoso.db')))
+
+    def set_loaded(self):
+        self.set_done('load_fact', self.get_fact_fingerprint())
+        self.set_done('load_ont', self.get_ont_fingerprint())
+
+    def reuse_virtuoso(self):
+        self.set_status('reusing existing FB...')
+        return self.ensure_virtuoso()
+
+    def prepare(self, mem=4):
+        if self._manifest is not None:
+            self._manifest.invalidate(*(LOAD_STAGES + POST_LOAD_STAGES))
+            if self._manifest.resume:
+                # facts must be reloaded into a clean FB
+                self.reset_virtuoso()
+
         # initialize virtuoso
         self.set_status('initializing virtuoso...')
         rc = self.init_virtuoso(mem=mem)
@@ -232,62 +458,211 @@ class FB(object):
             self.set_status('failed to start virtuoso')
             return rc
 
-        # load facts
-        self.set_status('loading facts...')
-        rc = self.load_fact()
-        if rc != 0:
-            self.set_status('faild to load facts')
-            return rc
-
         # load ontologies
-        self.set_status('loading ontologies...')
-        rc = self.load_ont()
+        if self._ont_loaded:
+            self.set_status('ontologies cloned from template')
+        else:
+            self.set_status('loading ontologies...')
+            rc = self.load_ont()
+            if rc != 0:
+                self.set_status('faild to load ontologies')
+                return rc
+
+        return 0
+
+    def build_fb(self, mem=4, preloaded=False):
+        fact_fp = self.get_fact_fingerprint()
+        ont_fp = self.get_ont_fingerprint()
+
+        if preloaded:
+            self.set_loaded()
+
+        elif self.is_loaded():
+            rc = self.reuse_virtuoso()
+            if rc != 0:
+                self.set_status('failed to start virtuoso')
+                return rc
+
+        else:
+            rc = self.prepare(mem=mem)
+            if rc != 0:
+                return rc
+            self.set_done('load_ont', ont_fp)
+
+            # load facts
+            self.set_status('loading facts...')
+            rc = self.load_fact()
+            if rc != 0:
+                self.set_status('faild to load facts')
+                return rc
+            self.set_done('load_fact', fact_fp)
+
+        # materialize facts
+        mat_fp = self.get_materialize_fingerprint(fact_fp, ont_fp)
+        if self.is_done('materialize', mat_fp):
+            self.set_status('facts already materialized')
+        elif self.ensure_virtuoso() != 0:
+            self.set_status('failed to start virtuoso')
+            return 1
+        else:
+            self.set_status('materializing facts...')
+            rc = self.materialize()
+            if rc != 0:
+                self.set_status('faild to materialize facts')
+                return rc
+            self.set_done('materialize', mat_fp)
+
+        return 0
+
+    def find_refactoring_pats(self, out_dir, conf=None, chgpat_dir=None):
+        if conf is None:
+            conf = self._conf
+        if chgpat_dir is None:
+            chgpat_dir = self._chgpat_dir
+        njobs = self.get_find_jobs()
+        with self._profiler.stage('find_refactoring', njobs=njobs) as st:
+            find_refactoring.find(WORK_DIR, self._proj_id, chgpat_dir,
+                                  out_dir,
+                                  self._pw, self._port,
+                                  per_ver=True,
+                                  conf=conf,
+                                  url_base_path=self._url_base_path,
+                                  targets=self._targets,
+                                  njobs=njobs)
+            st['nfiles'], st['nbytes'] = count_files(chgpat_dir, ['.ttl'])
+
+    def get_find_jobs(self):
+        # limited by the server threads configured for the FB
+        slots = virtuoso_ini.get_query_slots(os.path.join(self._fb_dir, 'virtuoso.ini'))
+        njobs = slots if self._find_jobs <= 0 else min(self._find_jobs, slots)
+        return njobs
+
+    def dump_ref_keys(self, out_file, cids=None):
+        njobs = self.get_find_jobs()
+        with self._profiler.stage('ref_keys', partitioned=self._partitioned,
+                                  njobs=njobs) as st:
+            st['nrows'] = ref_keys.dump(self._proj_id, out_file,
+                                        pw=self._pw, port=self._port,
+                                        cids=cids, merge=cids is not None,
+                                        ver_tbl=self._ver_tbl, targets=self._targets,
+                                        partitioned=self._partitioned, njobs=njobs)
+
+    def dump_dtor_map(self, out_file, cids=None):
+        njobs = self.get_find_jobs()
+        with self._profiler.stage('dtor_map', partitioned=self._partitioned,
+                                  njobs=njobs) as st:
+            st['nrows'] = ref_keys.dump_dtor_map(self._proj_id, out_file,
+                                                 pw=self._pw, port=self._port,
+                                                 cids=cids, merge=cids is not None,
+                                                 ver_tbl=self._ver_tbl,
+                                                 partitioned=self._partitioned,
+                                                 njobs=njobs,
+                                                 index=self._index_dtor_map)
+
+    def get_ref_json(self):
+        return os.path.join(REFACT_DIR, self._proj_id, 'ref_keys.json')
+
+    def get_dtor_json(self):
+        return os.path.join(REFACT_DIR, self._proj_id, 'dtor_map.json')
+
+    def get_materialize_fingerprint(self, fact_fp, ont_fp):
+        return fingerprint(fact_fp, ont_fp, materialize_supplementary_fact.QUERIES,
+                           self._max_iter, self._targets, self._localized)
+
+    def get_refactoring_fingerprint(self):
+        return fingerprint(self.get_fact_fingerprint(), self.get_ont_fingerprint(),
+                           materialize_supplementary_fact.QUERIES,
+                           find_refactoring.QUERIES, self._targets, self._localized)
+
+    def exists(self):
+        return (os.path.exists(os.path.join(self._fb_dir, 'virtuoso.db')) and
+                self._manifest is not None and
+                all(self._manifest.has(stage) for stage in LOAD_STAGES + POST_LOAD_STAGES))
+
+    def update(self, fact_dirs, conf, cids):
+        # add version pairs to an existing FB
+        logger.info(f'updating FB for "{self._proj_id}" with {", ".join(cids)}...')
+
+        rc = self.reuse_virtuoso()
         if rc != 0:
-            self.set_status('faild to load ontologies')
+            self.set_status('failed to start virtuoso')
             return rc
 
-        # materialize facts
+        self.set_status('loading facts...')
+        for fact_dir in fact_dirs:
+            rc = self.load_fact(fact_dir=fact_dir)
+            if rc != 0:
+                self.set_status('faild to load facts')
+                return rc
+
         self.set_status('materializing facts...')
-        rc = self.materialize()
+        rc = self.materialize(conf=conf)
         if rc != 0:
             self.set_status('faild to materialize facts')
             return rc
 
-        return 0
+        self.set_status('finding refactoring patterns...')
+        if not ensure_dir(REFACT_DIR):
+            return 1
+        chgpat_dir = os.path.join(self._chgpat_dir, get_custom_timestamp())
+        try:
+            self.find_refactoring_pats(REFACT_DIR, conf=conf, chgpat_dir=chgpat_dir)
+            self.load_chgpat(chgpat_dir=chgpat_dir)
+            self.dump_ref_keys(self.get_ref_json(), cids=cids)
+            self.dump_dtor_map(self.get_dtor_json(), cids=cids)
+        except Exception as e:
+            self.set_status(f'failed to find refactoring patterns: {e}')
+            return 1
+
+        # the FB now corresponds to the whole fact directory
+        fact_fp = self.get_fact_fingerprint()
+        ont_fp = self.get_ont_fingerprint()
+        self.set_loaded()
+        self.set_done('materialize', self.get_materialize_fingerprint(fact_fp, ont_fp))
+        fp = self.get_refactoring_fingerprint()
+        for stage in POST_LOAD_STAGES[1:]:
+            self.set_done(stage, fp)
+
+        self.set_status('finished.')
 
-    def find_refactoring_pats(self, out_dir):
-        find_refactoring.find(WORK_DIR, self._proj_id, self._chgpat_dir,
-                              out_dir,
-                              self._pw, self._port,
-                              per_ver=True,
-                              conf=self._conf,
-                              url_base_path=self._url_base_path)
+        return 0
 
-    def setup(self):
+    def setup(self, preloaded=False):
         logger.info(f'setting up FB for "{self._proj_id}"...')
 
         # build FB
         self.set_status('building FB...')
-        rc = self.build_fb(mem=self._mem)
+        rc = self.build_fb(mem=self._mem, preloaded=preloaded)
         if rc != 0 or self._build_only:
-            return
+            return rc
 
         # self.restart_virtuoso()
 
         # find refactoring patterns
         self.set_status('finding refactoring patterns...')
         if ensure_dir(REFACT_DIR):
+            fp = self.get_refactoring_fingerprint()
+            ref_json = self.get_ref_json()
+            dtor_json = self.get_dtor_json()
+            stages = [
+                ('find_refactoring', lambda: self.find_refactoring_pats(REFACT_DIR)),
+                ('load_chgpat', self.load_chgpat),
+                ('ref_keys', lambda: self.dump_ref_keys(ref_json)),
+                ('dtor_map', lambda: self.dump_dtor_map(dtor_json)),
+            ]
             try:
-                self.find_refactoring_pats(REFACT_DIR)
-                self.load_chgpat()
-                ref_json = os.path.join(REFACT_DIR, self._proj_id, 'ref_keys.json')
-                ref_keys.dump(self._proj_id, ref_json, pw=self._pw, port=self._port)
-                dtor_json = os.path.join(REFACT_DIR, self._proj_id, 'dtor_map.json')
-                ref_keys.dump_dtor_map(self._proj_id, dtor_json, pw=self._pw, port=self._port)
+                for stage, run in stages:
+                    if self.is_done(stage, fp):
+                        logger.info(f'skipping {stage} (already done)')
+                        continue
+                    if self.ensure_virtuoso() != 0:
+                        raise RuntimeError('virtuoso is not available')
+                    run()
+                    self.set_done(stage, fp)
             except Exception as e:
                 self.set_status(f'failed to find refactoring patterns: {e}')
                 # self.reset_virtuoso(proj_id)
-                return
+                return 1
 
         # self.restart_virtuoso()
 
@@ -299,6 +674,8 @@ class FB(object):
 
         self.set_status('finished.')
 
+        return 0
+
 
 if __name__ == '__main__':
     ap = create_argparser('Setup FB')
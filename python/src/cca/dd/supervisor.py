@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+'''
+  supervisor.py
+
+  Copyright 2024 Chiba Institute of Technology
+
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+'''
+
+__author__ = 'Masatomo Hashimoto <m.hashimoto@stair.center>'
+
+import os
+import time
+import signal
+import socket
+import subprocess
+import logging
+
+from .conf import VIRTUOSO_PW, VIRTUOSO_PORT, ISQL_CMD
+from .misc import rm
+
+from cca.ccautil import virtuoso
+
+logger = logging.getLogger()
+
+DBA_PW = 'dba'  # password of a freshly created DB
+
+LOCK_FILE_NAME = 'virtuoso.lck'  # LockFile of virtuoso.ini, holds "VIRT_PID=..."
+
+PING_TIMEOUT = 30
+READY_TIMEOUT = 600
+STOP_TIMEOUT = 300
+KILL_TIMEOUT = 30
+SQL_TIMEOUT = 300
+MAX_INTERVAL = 5.0
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def backoff(timeout, interval=0.1):
+    # yields until timeout with exponentially growing intervals
+    t0 = time.monotonic()
+    while True:
+        yield
+        if time.monotonic() - t0 > timeout:
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_INTERVAL)
+
+
+class Supervisor(object):
+    # tracks a virtuoso server by the PID in its lock file and by its port
+    def __init__(self, fb_dir, port=VIRTUOSO_PORT, pw=VIRTUOSO_PW):
+        self.fb_dir = fb_dir
+        self.port = port
+        self.pw = pw
+        self.lock_file = os.path.join(fb_dir, LOCK_FILE_NAME)
+
+    def read_pid(self):
+        pid = None
+        try:
+            with open(self.lock_file) as f:
+                for line in f:
+                    k, _, v = line.strip().partition('=')
+                    if k == 'VIRT_PID':
+                        pid = int(v)
+        except (OSError, ValueError):
+            pass
+        return pid
+
+    def get_pid(self):
+        pid = self.read_pid()
+        if pid is not None and not pid_exists(pid):
+            pid = None
+        return pid
+
+    def is_listening(self):
+        try:
+            with socket.create_connection(('localhost', self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def is_running(self):
+        return self.get_pid() is not None or self.is_listening()
+
+    def is_crashed(self):
+        # the lock file remains but its process is gone
+        pid = self.read_pid()
+        return pid is not None and not pid_exists(pid)
+
+    def ping(self, pw=None):
+        if pw is None:
+            pw = self.pw
+        if not self.is_listening():
+            return False
+        cmd = [ISQL_CMD, str(self.port), 'dba', pw, 'exec=status();']
+        try:
+            p = subprocess.run(cmd, capture_output=True, timeout=PING_TIMEOUT)
+            return p.returncode == 0
+        except Exception as e:
+            logger.debug(f'{e}')
+            return False
+
+    def exec_sql(self, sql, timeout=SQL_TIMEOUT):
+        # returns the output of isql or None on failure
+        cmd = [ISQL_CMD, str(self.port), 'dba', self.pw, f'exec={sql}']
+        try:
+            p = subprocess.run(cmd, capture_output=True, check=True, timeout=timeout)
+            return p.stdout.decode('utf-8', errors='replace')
+        except Exception as e:
+            logger.warning(f'{e}')
+            return None
+
+    def wait_ready(self, pw=None, timeout=READY_TIMEOUT):
+        for _ in backoff(timeout):
+            if self.ping(pw=pw):
+                return True
+            if self.is_crashed():
+                logger.warning(f'virtuoso died (port={self.port})')
+                return False
+        logger.warning(f'virtuoso is not ready in {timeout}s (port={self.port})')
+        return False
+
+    def wait_stopped(self, timeout=STOP_TIMEOUT):
+        for _ in backoff(timeout):
+            if not self.is_running():
+                return True
+        return False
+
+    def start(self, pw=None):
+        if self.is_running():
+            logger.warning(f'virtuoso is already running (port={self.port})')
+            return 1
+        if self.is_crashed():
+            logger.warning(f'removing stale "{self.lock_file}"...')
+            rm(self.lock_file)
+        logger.info(f'starting virtuoso (port={self.port})...')
+        v = virtuoso.base(dbdir=self.fb_dir, port=self.port)
+        rc = v.start_server()
+        if rc == 0 and not self.wait_ready(pw=pw):
+            rc = 1
+        return rc
+
+    def kill(self, pid):
+        for sig, timeout in ((signal.SIGTERM, STOP_TIMEOUT), (signal.SIGKILL, KILL_TIMEOUT)):
+            logger.warning(f'sending {sig.name} to virtuoso (pid={pid})...')
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                return True
+            if self.wait_stopped(timeout=timeout):
+                return True
+        return False
+
+    def shutdown(self):
+        stat = 0
+        if self.is_running():
+            logger.info(f'shutting down virtuoso (port={self.port})...')
+            pid = self.get_pid()
+            v = virtuoso.base(dbdir=self.fb_dir, port=self.port, pw=self.pw)
+            rc = v.shutdown_server()
+            if rc != 0 or not self.wait_stopped():
+                if pid is None or not self.kill(pid):
+                    stat = 1
+        if stat == 0 and self.is_crashed():
+            rm(self.lock_file)
+        return stat
+
+    def restart(self):
+        rc = self.shutdown()
+        if rc == 0:
+            rc = self.start()
+        return rc
+
+    def ensure(self):
+        # (re)starts virtuoso unless it is up
+        rc = 0
+        if self.is_crashed():
+            logger.warning(f'virtuoso crashed (port={self.port}), restarting...')
+            rc = self.start()
+        elif not self.is_running():
+            rc = self.start()
+        elif not self.wait_ready(timeout=PING_TIMEOUT):
+            logger.warning(f'virtuoso does not respond (port={self.port}), restarting...')
+            rc = self.restart()
+        return rc
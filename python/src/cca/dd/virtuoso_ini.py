@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
+import os
+import logging
+from argparse import ArgumentTypeError
 
 from .common import VIRTUOSO_PORT
 
+logger = logging.getLogger()
+
 BUFSIZE_TBL = {
     2: (170000, 130000),
     4: (340000, 250000),
@@ -15,6 +20,31 @@ BUFSIZE_TBL = {
 
 DEFAULT_BUFSIZES = BUFSIZE_TBL[8]
 
+MEM_CHOICES = sorted(BUFSIZE_TBL.keys())
+AUTO = 'auto'
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+BUF_SIZE = 8192
+
+# shares of the memory of an FB in the auto profile
+BUF_SHARE = 0.5
+QUERY_MEM_SHARE = 0.25
+
+FIXED_PARAMS = {
+    'max_query_mem': '4G',
+    'hash_join_space': '4G',
+    'vector_size': 1000,
+    'threads_per_query': 1,
+    'async_queue_max_threads': 2,
+    'server_threads': 10,
+}
+
+RESULT_SET_MAX_ROWS = 1000000  # rows beyond are silently dropped
+MAX_SORTED_TOP_ROWS = 10 * RESULT_SET_MAX_ROWS  # bound of LIMIT with ORDER BY
+
+RESERVED_THREADS = 2  # server threads left for loaders, monitors and isql
+
 
 INI_FMT = '''
 [Database]
@@ -43,11 +73,13 @@ ServerPort                      = %(port)d
 LiteMode                        = 0
 DisableUnixSocket               = 1
 DisableTcpSocket                = 0
-MaxClientConnections            = 10
+MaxClientConnections            = %(server_threads)d
+ServerThreads                   = %(server_threads)d
 CheckpointInterval              = -1
 O_DIRECT                        = 0
 CaseMode                        = 2
 MaxStaticCursorRows             = 5000
+MaxSortedTopRows                = %(max_sorted_top_rows)d
 CheckpointAuditTrail            = 0
 AllowOSCalls                    = 0
 SchedulerInterval               = 10
@@ -66,13 +98,13 @@ TransactionAfterImageLimit      = 1600000000
 PrefixResultNames               = 0
 MacSpotlight                    = 0
 IndexTreeMaps                   = 64
-MaxQueryMem                     = 4G
-HashJoinSpace                   = 4G
-VectorSize                      = 1000
+MaxQueryMem                     = %(max_query_mem)s
+HashJoinSpace                   = %(hash_join_space)s
+VectorSize                      = %(vector_size)d
 MaxVectorSize                   = 1000000
 AdjustVectorSize                = 0
-ThreadsPerQuery                 = 1
-AsyncQueueMaxThreads            = 2
+ThreadsPerQuery                 = %(threads_per_query)d
+AsyncQueueMaxThreads            = %(async_queue_max_threads)d
 
 NumberOfBuffers = %(nbufs)d
 MaxDirtyBuffers = %(mdbufs)d
@@ -126,7 +158,7 @@ DynamicLocal                    = 0
 DefaultHost                     = localhost:8890
 
 [SPARQL]
-ResultSetMaxRows                = 1000000
+ResultSetMaxRows                = %(result_set_max_rows)d
 MaxQueryCostEstimationTime      = 400
 MaxQueryExecutionTime           = 60
 DefaultQuery                    = select distinct ?Concept where {[] a ?Concept} LIMIT 100
@@ -134,14 +166,124 @@ DeferInferenceRulesInit         = 0
 '''
 
 
-def gen_ini(db_root, fact_root, ont_root, outfile, mem=4, port=VIRTUOSO_PORT):
-    nbufs, mdbufs = BUFSIZE_TBL.get(mem, DEFAULT_BUFSIZES)
-    ini = INI_FMT % {'db_root': db_root,
-                     'port': port,
-                     'fact_root': fact_root,
-                     'ont_root': ont_root,
-                     'nbufs': nbufs,
-                     'mdbufs': mdbufs}
+def parse_mem(s):
+    # for argparse: GB in MEM_CHOICES or "auto"
+    if s == AUTO:
+        return s
+    try:
+        mem = int(s)
+    except ValueError:
+        mem = None
+    if mem not in MEM_CHOICES:
+        choices = ', '.join(str(x) for x in MEM_CHOICES)
+        raise ArgumentTypeError(f'invalid memory size: {s} (choose from {choices}, {AUTO})')
+    return mem
+
+
+def read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def get_mem_limit():
+    # bytes available to this cgroup (or host)
+    limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in ('/sys/fs/cgroup/memory.max',                     # cgroup v2
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes'):  # cgroup v1
+        x = read_first_line(path)
+        if x is not None and x.isdigit():
+            limit = min(limit, int(x))
+            break
+    return limit
+
+
+def get_cpu_limit():
+    # number of CPUs available to this cgroup (or process)
+    try:
+        ncpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncpus = os.cpu_count() or 1
+    quota = None
+    x = read_first_line('/sys/fs/cgroup/cpu.max')  # cgroup v2: "QUOTA PERIOD"
+    if x is not None:
+        q, _, p = x.partition(' ')
+        if q.isdigit() and p.isdigit():
+            quota = int(q) / int(p)
+    else:
+        q = read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')  # cgroup v1
+        p = read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if q is not None and p is not None and int(q) > 0:
+            quota = int(q) / int(p)
+    if quota is not None:
+        ncpus = min(ncpus, max(1, int(quota)))
+    return ncpus
+
+
+def get_auto_params(nfbs=1):
+    # derives buffers and query resources from the share of each of nfbs FBs
+    nfbs = max(1, nfbs)
+    mem = get_mem_limit() // nfbs
+    ncpus = max(1, get_cpu_limit() // nfbs)
+    nbufs = int(mem * BUF_SHARE) // BUF_SIZE
+    query_mem = f'{max(256, int(mem * QUERY_MEM_SHARE) // MB)}M'
+    params = {
+        'nbufs': nbufs,
+        'mdbufs': nbufs * 3 // 4,
+        'max_query_mem': query_mem,
+        'hash_join_space': query_mem,
+        'vector_size': FIXED_PARAMS['vector_size'],
+        'threads_per_query': ncpus,
+        'async_queue_max_threads': max(2, ncpus),
+        'server_threads': max(FIXED_PARAMS['server_threads'], ncpus + RESERVED_THREADS),
+    }
+    logger.info(f'auto profile for {nfbs} FB(s): {mem / GB:.1f}GB and {ncpus} CPU(s) each')
+    return params
+
+
+def get_mem_gb(mem, nfbs=1):
+    # memory (GB) of an FB
+    if mem == AUTO:
+        return max(1, get_mem_limit() // max(1, nfbs) // GB)
+    return mem
+
+
+def get_server_threads(ini_file):
+    n = FIXED_PARAMS['server_threads']
+    try:
+        with open(ini_file) as f:
+            for line in f:
+                k, _, v = line.partition('=')
+                if k.strip() == 'ServerThreads':
+                    n = int(v.split(';')[0])
+    except (OSError, ValueError) as e:
+        logger.warning(f'{e}')
+    return n
+
+
+def get_query_slots(ini_file):
+    # queries a server can run concurrently besides other clients
+    return max(1, get_server_threads(ini_file) - RESERVED_THREADS)
+
+
+def gen_ini(db_root, fact_root, ont_root, outfile, mem=4, port=VIRTUOSO_PORT, nfbs=1):
+    if mem == AUTO:
+        params = get_auto_params(nfbs)
+    else:
+        params = FIXED_PARAMS.copy()
+        params['nbufs'], params['mdbufs'] = BUFSIZE_TBL.get(mem, DEFAULT_BUFSIZES)
+    logger.info(' '.join(f'{k}={v}' for k, v in params.items()))
+    ini = INI_FMT % dict(params,
+                         result_set_max_rows=RESULT_SET_MAX_ROWS,
+                         max_sorted_top_rows=MAX_SORTED_TOP_ROWS,
+                         db_root=db_root,
+                         port=port,
+                         fact_root=fact_root,
+                         ont_root=ont_root)
 
     with open(outfile, 'w') as f:
         f.write(ini)
+
+    return params
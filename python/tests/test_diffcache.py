@@ -0,0 +1,66 @@
+import os
+import time
+
+from cca.dd.diffcache import DiffCache, USED_STAMP_NAME, MTIME_SLACK
+
+
+def make_entry(base_dir, ent, size, t):
+    d = os.path.join(base_dir, ent)
+    os.makedirs(d)
+    p = os.path.join(d, 'stat')
+    with open(p, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(p, (t, t))
+    os.utime(d, (t, t))
+    os.utime(os.path.dirname(d), (t, t))
+    return d
+
+
+def age_index(cache, dt):
+    # as if the last scan were done dt seconds earlier
+    index = cache.read_index()
+    index['scanned'] -= dt
+    cache.write_index(index)
+
+
+def test_stamped_entry_is_rescanned(tmp_path):
+    base_dir = str(tmp_path)
+    cache = DiffCache(base_dir, max_gb=1)
+    old = time.time() - 10 * MTIME_SLACK
+    d = make_entry(base_dir, os.path.join('opts', 'e0'), 10, old)
+    cache.update()
+    assert cache.read_index()['entries'][os.path.join('opts', 'e0')]['size'] == 10
+
+    # rewritten in place: the directory mtime does not change
+    p = os.path.join(d, 'stat')
+    with open(p, 'wb') as f:
+        f.write(b'x' * 20)
+    os.utime(d, (old, old))
+    age_index(cache, 2 * MTIME_SLACK)
+    cache.update()
+    assert cache.read_index()['entries'][os.path.join('opts', 'e0')]['size'] == 10
+
+    # a run using the entry stamps it
+    with open(os.path.join(d, USED_STAMP_NAME), 'a'):
+        pass
+    os.utime(d, (old, old))
+    cache.update()
+    ent = cache.read_index()['entries'][os.path.join('opts', 'e0')]
+    assert ent['size'] == 20
+    assert ent['used'] > old + MTIME_SLACK
+
+
+def test_evicts_least_recently_used(tmp_path):
+    base_dir = str(tmp_path)
+    cache = DiffCache(base_dir, max_gb=1)
+    old = time.time() - 100000
+    d0 = make_entry(base_dir, os.path.join('opts', 'e0'), 10, old)
+    make_entry(base_dir, os.path.join('opts', 'e1'), 10, old + 1)
+    with open(os.path.join(d0, USED_STAMP_NAME), 'a'):
+        pass
+    os.utime(d0, (old, old))
+    cache.max_bytes = 15
+    nentries, total, nevicted = cache.update(full=True)
+    assert nevicted == 1
+    assert os.path.exists(d0)
+    assert not os.path.exists(os.path.join(base_dir, 'opts', 'e1'))
@@ -0,0 +1,44 @@
+import os
+
+from cca.dd.manifest import Manifest
+
+
+def reopen(path):
+    # a later --incremental run
+    return Manifest(path, resume=True)
+
+
+def test_failed_update_is_retried(tmp_path):
+    path = os.path.join(tmp_path, 'manifest.json')
+    cids = ['c0', 'c1']
+    fps = ['fp0', 'fp1']
+    stages = [f'update:{cid}' for cid in cids]
+
+    m = reopen(path)
+    for cid, fp in zip(cids, fps):
+        m.set_done(f'diff:{cid}', fp)
+    m.set_done('update:c0', 'fp0')
+    # the update of c1 fails after it is compared
+
+    m = reopen(path)
+    assert m.is_done('diff:c1', 'fp1')
+    assert m.get_undone(stages, fps) == [1]
+
+    # the retry succeeds
+    m.set_done('update:c1', 'fp1')
+
+    m = reopen(path)
+    assert m.get_undone(stages, fps) == []
+
+
+def test_changed_pair_is_updated_again(tmp_path):
+    path = os.path.join(tmp_path, 'manifest.json')
+    m = reopen(path)
+    m.set_done('update:c0', 'fp0')
+    assert reopen(path).get_undone(['update:c0'], ['fp0*']) == [0]
+
+
+def test_nothing_reused_without_resume(tmp_path):
+    path = os.path.join(tmp_path, 'manifest.json')
+    reopen(path).set_done('update:c0', 'fp0')
+    assert Manifest(path).get_undone(['update:c0'], ['fp0']) == [0]